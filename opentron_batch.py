@@ -0,0 +1,235 @@
+"""
+Generates and validates a protocol file for every plate of a batch.
+
+A manifest lists one plate or experiment per line as JSON, with the script it
+is based on, its deck and plan, either inline or as files, and any run
+options of its own:
+
+    {"name": "plate_01", "template": "opentron_script_MS_topup-uptoF5.py",
+     "move_path": "plate_01.jsonl", "run_options": {"minimum_volume": 5000}}
+
+Paths are relative to the manifest. A field left out is taken from the
+template. Each protocol is written as a copy of its template holding its own
+deck, plan and run options, and the file written is then run on the
+recording simulator; a protocol that fails for any reason is removed and its
+error reported. Entries are generated and simulated in
+parallel in a process pool, and a summary of the estimated run time, tips
+and substance demand of each protocol is printed and can be saved as JSON.
+
+Usage
+-----
+    python opentron_batch.py manifest.jsonl --out protocols --summary summary.json
+"""
+import argparse
+import json
+import os
+import sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+from opentron_estimate import PLATE_SLOT, estimate_plan, load_protocol_data, read_move_commands
+from opentron_shard import expand_plan, source_substance, write_protocol
+from opentron_simulator import simulate_protocol
+
+
+@lru_cache(maxsize=None)
+def load_template(path):
+    """
+    Literal data of a template script, read once per process.
+    """
+    return load_protocol_data(path)
+
+
+def read_manifest(path, template=None):
+    """
+    Reads the entries of a manifest, resolving their paths.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path of the manifest, as JSON Lines.
+    template : str or Path, optional
+        Script used by the entries that do not name one.
+
+    Returns
+    -------
+    list of dict
+        Entries with a `name` and absolute `template`, `substance_path` and
+        `move_path`.
+
+    Raises
+    ------
+    ValueError
+        If an entry has no template or two entries share a name.
+
+    """
+    folder = Path(path).resolve().parent
+    entries = []
+    names = set()
+    with open(str(path)) as f:
+        for line, text in enumerate(f, 1):
+            if not text.strip():
+                continue
+            entry = json.loads(text)
+            entry.setdefault("template", template)
+            if entry["template"] is None:
+                raise ValueError(f"Line {line}: no template for this entry.")
+            for key in ("template", "substance_path", "move_path"):
+                if entry.get(key) is not None:
+                    entry[key] = str(folder / entry[key])
+            entry.setdefault("name", f"{Path(entry['template']).stem}_{line}")
+            if entry["name"] in names:
+                raise ValueError(f"Line {line}: name {entry['name']!r} is used twice.")
+            names.add(entry["name"])
+            entries.append(entry)
+    return entries
+
+
+def build_protocol(entry, out_dir):
+    """
+    Writes the protocol of one manifest entry and validates it.
+
+    Parameters
+    ----------
+    entry : dict
+        Manifest entry, as returned by `read_manifest`.
+    out_dir : str or Path
+        Folder to write the protocol to.
+
+    Returns
+    -------
+    dict
+        Name and path of the protocol with its estimated run time, tips,
+        aspirations and demand of each substance, or the `error` it failed
+        with.
+
+    """
+    data = load_template(entry["template"])
+    options = dict(data["run_options"])
+    options.update(entry.get("run_options", {}))
+    # The files are read here so the protocol holds the whole plan
+    options.update(substance_path=None, move_path=None)
+    substance_locations = entry.get("substance_locations", data["substance_locations"])
+    if entry.get("substance_path"):
+        with open(entry["substance_path"]) as f:
+            substance_locations = json.load(f)
+    move_commands = entry.get("move_commands", data["move_commands"])
+    if entry.get("move_path"):
+        move_commands = list(read_move_commands(entry["move_path"]))
+    path = Path(out_dir) / f"{entry['name']}.py"
+    summary = {"name": entry["name"], "path": str(path)}
+    overrides = {
+        key: value
+        for key, value in entry.get("run_options", {}).items()
+        if key not in ("substance_path", "move_path")
+    }
+    try:
+        write_protocol(
+            entry["template"],
+            path,
+            substance_locations,
+            move_commands,
+            entry["name"],
+            run_options=overrides,
+        )
+        context = simulate_protocol(path)
+    # Any failure is this entry's alone and must not stop the rest of the batch
+    except Exception as error:
+        if path.exists():
+            path.unlink()
+        summary["error"] = f"{type(error).__name__}: {error}"
+        return summary
+    commands = [command["command"] for command in context.command_log]
+    demand = defaultdict(lambda: 0)
+    plate_slot = options.get("plate_slot", PLATE_SLOT)
+    for move in expand_plan(substance_locations, move_commands, plate_slot):
+        _, substance = source_substance(move, substance_locations)
+        demand[substance] += move["amount"]
+    summary.update(
+        {
+            "time": estimate_plan(
+                entry["template"], substance_locations, move_commands, options
+            )["total"],
+            "tips": commands.count("pick_up_tip"),
+            "aspirates": commands.count("aspirate"),
+            "demand": dict(demand),
+        }
+    )
+    return summary
+
+
+def build_batch(entries, out_dir, workers=None):
+    """
+    Writes and validates the protocols of a batch in a process pool.
+
+    Parameters
+    ----------
+    entries : list of dict
+        Manifest entries, as returned by `read_manifest`.
+    out_dir : str or Path
+        Folder to write the protocols to.
+    workers : int, optional
+        Number of processes, one per CPU by default.
+
+    Returns
+    -------
+    list of dict
+        Summary of each protocol, in manifest order.
+
+    """
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    # Large chunks keep the pool's overhead small next to a plate's work
+    chunksize = max(1, len(entries) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(
+            pool.map(build_protocol, entries, [out_dir] * len(entries), chunksize=chunksize)
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("manifest")
+    parser.add_argument("--template", help="script for the entries that do not name one")
+    parser.add_argument("--out", default="protocols", help="folder for the protocols")
+    parser.add_argument("--summary", help="write the summary to this JSON file")
+    parser.add_argument("--workers", type=int, help="number of processes")
+    args = parser.parse_args()
+
+    summaries = build_batch(
+        read_manifest(args.manifest, args.template), args.out, args.workers
+    )
+    print(f"{'protocol':<30}{'robot min':>11}{'tips':>6}{'aspirates':>11}  demand (uL)")
+    failed = 0
+    total_demand = defaultdict(lambda: 0)
+    for summary in summaries:
+        if "error" in summary:
+            failed += 1
+            print(f"{summary['name']:<30}  failed: {summary['error'].splitlines()[-1]}")
+            continue
+        for substance, amount in summary["demand"].items():
+            total_demand[substance] += amount
+        demand = ", ".join(
+            f"{substance} {amount:.0f}" for substance, amount in summary["demand"].items()
+        )
+        if len(summary["demand"]) > 3:
+            demand = (
+                f"{len(summary['demand'])} substances, "
+                f"{sum(summary['demand'].values()):.0f} in total"
+            )
+        print(
+            f"{summary['name']:<30}{summary['time'] / 60:>11.1f}{summary['tips']:>6}"
+            f"{summary['aspirates']:>11}  {demand}"
+        )
+    print(
+        f"{len(summaries) - failed} protocols written, {failed} failed, "
+        f"{sum(summary.get('time', 0) for summary in summaries) / 60:.1f} robot min in total"
+    )
+    for substance, amount in sorted(total_demand.items()):
+        print(f"    {substance:<20}{amount:>12.0f} uL")
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump(summaries, f, indent=4)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,307 @@
+"""
+Benchmarks of the protocol scripts on synthetic plans of growing scale.
+
+Each case builds a deck of source plates and a plan for a 54, 96 or 384 well
+destination plate with mixed volumes, and runs the script's `run()` on the
+recording simulator. The host cost (run time and peak memory) and the robot
+cost (commands, tips, aspirates and estimated run time) of each case are
+recorded. Results are saved as JSON so that a later change can be compared
+against a baseline.
+
+Scripts that schedule moves by step, such as the combined transfer and top-up
+script, need a "step" on each move and are not covered by the synthetic plans.
+
+Usage
+-----
+    python opentron_benchmark.py --save opentron_benchmark_baseline.json
+    python opentron_benchmark.py --compare opentron_benchmark_baseline.json
+"""
+import argparse
+import contextlib
+import copy
+import io
+import json
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from opentron_estimate import LABWARE, PLATE_SLOT, PLATE_TYPE, estimate_protocol
+from opentron_simulator import WELLS, RecordingContext, load_protocol
+
+# Destination plates, keyed by well count, with the slot they are loaded in
+DESTINATIONS = {
+    54: (PLATE_TYPE, PLATE_SLOT),
+    96: ("corning_96_wellplate_360ul_flat", 11),
+    384: ("corning_384_wellplate_112ul_flat", 11),
+}
+SUBSTANCE_COUNTS = (1, 10, 100, 500)
+# Amounts dosed into the destination wells (in uL)
+VOLUMES = (10, 25, 50, 100, 150, 300)
+
+SOURCE_TYPE = "nest_96_wellplate_2ml_deep"
+SOURCE_SLOTS = (3, 5, 6, 7, 8, 9, 10)
+# Volume kept in each source well (in uL)
+SOURCE_RESERVE = 100
+
+# Metrics compared against the baseline, with the increase that counts as a
+# regression (host costs vary from machine to machine)
+TOLERANCES = {
+    "planning_time": 0.5,
+    "peak_memory": 0.2,
+    "commands": 0.0,
+    "tips": 0.0,
+    "aspirates": 0.0,
+    "robot_time": 0.01,
+}
+
+# Next to this file, wherever the benchmarks are run from
+DEFAULT_SCRIPT = str(
+    Path(__file__).resolve().parent / "opentron_script_MS_topup-uptoF5.py"
+)
+
+
+def generate_plan(wells, substances, seed=0):
+    """
+    Builds a synthetic deck and plan.
+
+    Notes
+    -----
+    Every substance is dosed into at least one well and every destination well
+    receives at least one substance, so the plan has as many moves as the
+    larger of the two counts. Each substance fills as many source wells as its
+    demand needs.
+
+    Parameters
+    ----------
+    wells : int
+        Number of wells of the destination plate, a key of `DESTINATIONS`.
+    substances : int
+        Number of distinct substances.
+    seed : int
+        Seed of the volume choices.
+
+    Returns
+    -------
+    tuple of dict and list of dict
+        Deck information and move commands, as in the protocol scripts.
+
+    """
+    rng = random.Random(seed)
+    plate_type, plate_slot = DESTINATIONS[wells]
+    rows, columns, _ = LABWARE[plate_type]
+    targets = [
+        f"{chr(ord('A') + row)}{column + 1}"
+        for row in range(rows)
+        for column in range(columns)
+    ]
+    moves = []
+    demand = {}
+    for index in range(max(wells, substances)):
+        substance = f"S{index % substances:03d}"
+        amount = rng.choice(VOLUMES)
+        demand[substance] = demand.get(substance, 0) + amount
+        moves.append(
+            {
+                "substance": substance,
+                "amount": amount,
+                "plate": str(plate_slot),
+                "location": [targets[index % wells]],
+            }
+        )
+    # Substances are moved one after another, as a plan file would list them
+    moves.sort(key=lambda move: move["substance"])
+
+    source_rows, source_columns, _ = LABWARE[SOURCE_TYPE]
+    source_wells = [
+        (slot, f"{chr(ord('A') + row)}{column + 1}")
+        for slot in SOURCE_SLOTS
+        if slot != plate_slot
+        for column in range(source_columns)
+        for row in range(source_rows)
+    ]
+    capacity = WELLS[SOURCE_TYPE][3]
+    deck = {}
+    for substance, amount in demand.items():
+        # Leave room for a disposal volume on each trip
+        amount = amount * 1.2 + 20
+        while amount > 0:
+            if not source_wells:
+                raise ValueError(
+                    f"{substances} substances for {wells} wells do not fit on the deck."
+                )
+            slot, well = source_wells.pop(0)
+            fill = min(capacity, amount + SOURCE_RESERVE)
+            deck.setdefault(str(slot), {"name": "Source", "type": SOURCE_TYPE})
+            deck[str(slot)][well] = {"substance": substance, "amount": fill}
+            amount -= fill - SOURCE_RESERVE
+    if plate_slot != PLATE_SLOT:
+        deck[str(plate_slot)] = {"name": "Destination", "type": plate_type}
+    return deck, moves
+
+
+def run_case(script, wells, substances, seed=0, module=None, **run_options):
+    """
+    Runs one benchmark case.
+
+    Notes
+    -----
+    Only the script's `run()` is timed and traced, so the host cost is that
+    of the plan rather than of compiling the script.
+
+    Parameters
+    ----------
+    script : str or Path
+        Path of the protocol script.
+    wells : int
+        Number of wells of the destination plate.
+    substances : int
+        Number of distinct substances.
+    seed : int
+        Seed of the volume choices.
+    module : module, optional
+        The script as returned by `load_protocol`, loaded here if not given.
+    **run_options
+        Overrides of the script's `run_options`.
+
+    Returns
+    -------
+    dict
+        Metrics of the case.
+
+    """
+    if module is None:
+        module = load_protocol(script)
+    deck, moves = generate_plan(wells, substances, seed)
+    with tempfile.TemporaryDirectory() as folder:
+        substance_path = Path(folder) / "deck.json"
+        move_path = Path(folder) / "moves.jsonl"
+        with open(str(substance_path), "w") as f:
+            json.dump(deck, f)
+        with open(str(move_path), "w") as f:
+            for move in moves:
+                f.write(json.dumps(move) + "\n")
+        options = {
+            "substance_path": str(substance_path),
+            "move_path": str(move_path),
+            "minimum_volume": SOURCE_RESERVE,
+        }
+        options.update(run_options)
+        # Enough tip racks for one tip per substance
+        context = RecordingContext(tip_racks=substances // 96 + 1)
+        # Each case starts from the script's own run options
+        defaults = module.run_options
+        module.run_options = copy.deepcopy(defaults)
+        module.run_options.update(options)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                tracemalloc.start()
+                start = time.perf_counter()
+                module.run(context)
+                planning_time = time.perf_counter() - start
+                _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+            module.run_options = defaults
+        robot_time = estimate_protocol(script, **options)["total"]
+    commands = [entry["command"] for entry in context.command_log]
+    return {
+        "wells": wells,
+        "substances": substances,
+        "moves": len(moves),
+        "planning_time": planning_time,
+        "peak_memory": peak_memory,
+        "commands": len(commands),
+        "tips": commands.count("pick_up_tip"),
+        "aspirates": commands.count("aspirate"),
+        "robot_time": robot_time,
+    }
+
+
+def run_benchmarks(script=DEFAULT_SCRIPT, **run_options):
+    """
+    Runs every benchmark case.
+
+    Parameters
+    ----------
+    script : str or Path
+        Path of the protocol script.
+    **run_options
+        Overrides of the script's `run_options`.
+
+    Returns
+    -------
+    dict
+        Metrics of each case, keyed by "<wells>x<substances>".
+
+    """
+    # Compiled once, outside of what is timed
+    module = load_protocol(script)
+    return {
+        f"{wells}x{substances}": run_case(
+            script, wells, substances, module=module, **run_options
+        )
+        for wells in DESTINATIONS
+        for substances in SUBSTANCE_COUNTS
+    }
+
+
+def compare(results, baseline):
+    """
+    Lists the metrics that got worse than the baseline by more than their tolerance.
+
+    Parameters
+    ----------
+    results : dict
+        Metrics of each case, as returned by `run_benchmarks`.
+    baseline : dict
+        Metrics of each case from an earlier run.
+
+    Returns
+    -------
+    list of str
+        One line per regression.
+
+    """
+    regressions = []
+    for case, metrics in results.items():
+        if case not in baseline:
+            continue
+        for metric, tolerance in TOLERANCES.items():
+            before = baseline[case][metric]
+            after = metrics[metric]
+            if after > before * (1 + tolerance) + 1e-9:
+                regressions.append(f"{case} {metric}: {before:.6g} -> {after:.6g}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("script", nargs="?", default=DEFAULT_SCRIPT)
+    parser.add_argument("--save", help="write the results to a baseline file")
+    parser.add_argument("--compare", help="compare the results with a baseline file")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.script)
+    print(
+        f"{'case':<10}{'moves':>7}{'time ms':>9}{'peak kB':>9}"
+        f"{'commands':>10}{'tips':>6}{'aspirates':>11}{'robot min':>11}"
+    )
+    for case, metrics in results.items():
+        print(
+            f"{case:<10}{metrics['moves']:>7}{metrics['planning_time'] * 1000:>9.0f}"
+            f"{metrics['peak_memory'] / 1024:>9.0f}{metrics['commands']:>10}"
+            f"{metrics['tips']:>6}{metrics['aspirates']:>11}"
+            f"{metrics['robot_time'] / 60:>11.1f}"
+        )
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f))
+        for line in regressions:
+            print(f"Regression: {line}")
+        sys.exit(1 if regressions else 0)
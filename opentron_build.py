@@ -0,0 +1,156 @@
+"""
+Writes the shared engine into the protocol scripts.
+
+The Opentrons app runs a protocol from a single file, so each script carries
+a copy of `opentron_engine.py`: its imports at the top of the script and the
+rest of it at the end, each between marker comments. The engine is edited in
+one place and written into the scripts with this tool; with `--check` the
+scripts are left alone and the tool fails if any copy is out of date.
+
+Usage
+-----
+    python opentron_build.py
+    python opentron_build.py --check
+"""
+import argparse
+import ast
+import sys
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+ENGINE = HERE / "opentron_engine.py"
+PROTOCOLS = [
+    HERE / "opentron_script_MS_topup-uptoF5.py",
+    HERE / "opentron_script_MS_transfer_upto_F8.py",
+    HERE / "opentron_script_MS_transfer_and_topup.py",
+]
+
+# First and last line of each part of the engine in a script
+MARKERS = {
+    "imports": (
+        "# --- Engine imports, written from opentron_engine.py by opentron_build.py ---\n",
+        "# --- End of engine imports ---\n",
+    ),
+    "body": (
+        "# --- Engine, written from opentron_engine.py by opentron_build.py: "
+        "edit it there ---\n",
+        "# --- End of engine ---\n",
+    ),
+}
+
+
+def read_engine(path=ENGINE):
+    """
+    Imports and body of the engine, as written into the scripts.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path of the engine.
+
+    Returns
+    -------
+    dict
+        Text of the engine's leading imports and of the rest of it after its
+        docstring, keyed by "imports" and "body".
+
+    """
+    with open(str(path)) as f:
+        source = f.read()
+    lines = source.splitlines(keepends=True)
+    tree = ast.parse(source)
+    nodes = tree.body
+    # The module docstring is not copied
+    if ast.get_docstring(tree) is not None:
+        nodes = nodes[1:]
+    first = last = nodes[0].lineno
+    for node in nodes:
+        if not isinstance(node, (ast.Import, ast.ImportFrom)):
+            break
+        last = node.end_lineno
+    return {
+        "imports": "".join(lines[first - 1:last]),
+        "body": "".join(lines[last:]).strip("\n") + "\n",
+    }
+
+
+def build_protocol(path, engine):
+    """
+    Source of a protocol script with its copy of the engine brought up to date.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path of the protocol script.
+    engine : dict
+        The engine, as returned by `read_engine`.
+
+    Returns
+    -------
+    str
+        Source of the script.
+
+    Raises
+    ------
+    RuntimeError
+        If the script does not have each pair of marker comments once.
+
+    """
+    with open(str(path)) as f:
+        source = f.read()
+    for part, (begin, end) in MARKERS.items():
+        if source.count(begin) != 1 or source.count(end) != 1:
+            raise RuntimeError(f"{path} does not mark where the engine {part} go.")
+        start = source.index(begin) + len(begin)
+        stop = source.index(end, start)
+        source = source[:start] + engine[part] + source[stop:]
+    return source
+
+
+def build_protocols(paths, engine_path=ENGINE, check=False):
+    """
+    Writes the engine into each protocol script.
+
+    Parameters
+    ----------
+    paths : list of str or Path
+        Paths of the protocol scripts.
+    engine_path : str or Path
+        Path of the engine.
+    check : bool
+        Only report the scripts whose copy is out of date, leaving them alone.
+
+    Returns
+    -------
+    list of str or Path
+        The scripts whose copy of the engine was out of date.
+
+    """
+    engine = read_engine(engine_path)
+    stale = []
+    for path in paths:
+        with open(str(path)) as f:
+            source = f.read()
+        built = build_protocol(path, engine)
+        if built == source:
+            continue
+        stale.append(path)
+        if not check:
+            with open(str(path), "w") as f:
+                f.write(built)
+    return stale
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("scripts", nargs="*", help="protocol scripts, all of them by default")
+    parser.add_argument("--engine", default=str(ENGINE), help="path of the engine")
+    parser.add_argument(
+        "--check", action="store_true", help="fail if a script's engine is out of date"
+    )
+    args = parser.parse_args()
+
+    stale = build_protocols(args.scripts or PROTOCOLS, args.engine, check=args.check)
+    for path in stale:
+        print(f"{path}: {'out of date' if args.check else 'written'}")
+    sys.exit(1 if args.check and stale else 0)
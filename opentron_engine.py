@@ -0,0 +1,2693 @@
+"""
+Liquid handling engine shared by the Opentrons protocol scripts.
+
+The Opentrons app runs a protocol from a single file, so the engine is not
+imported by the scripts: `opentron_build.py` writes its imports and the rest
+of it into each script, between marker comments, and the copies are never
+edited by hand. A script keeps its own `metadata`, deck and plan literals,
+`run_options` and `move_schema`, and defines the two functions the engine
+calls:
+
+``load_pipettes(ot)``
+    Loads the tip racks and pipettes and returns the pipettes, each with the
+    `options` its liquid handling reads: the swelling, air gap, blow out and
+    distribute options of `run_options`.
+``plan_moves(ot, travel=None)``
+    The moves of the plan, in the order they are made, with the pipette for
+    each.
+
+Usage
+-----
+    python opentron_build.py
+"""
+from opentrons import protocol_api
+import csv
+import json
+import logging
+import logging.handlers
+import os
+import sqlite3
+import sys
+from pathlib import Path
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import groupby
+from math import hypot
+from opentrons.types import Point
+import numpy as np
+import time
+
+
+# Rough time the robot takes for the commands dropped by optimise_handling (in s)
+command_time = {
+    "trip": 3.0,
+    "dispense": 1.0,
+    "air_gap": 1.0,
+    "blow_out": 1.0,
+    "move_to": 0.5,
+}
+
+# Gantry speeds, lift between wells and time of the tip commands, for the
+# modelled time of the run (in mm/s, mm and s)
+clock_model = {
+    "gantry_speed": 400,
+    "z_speed": 125,
+    "lift": 60,
+    "pick_up_tip": 3.0,
+    "drop_tip": 2.5,
+}
+
+
+logger = logging.getLogger(metadata["protocolName"])
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a log record as one compact JSON line.
+
+    Notes
+    -----
+    A record logged with a dict argument, as in
+    `logger.debug("Move %(substance)s to %(location)s", move)`, keeps the
+    dict as fields of the line.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if isinstance(record.args, dict):
+            entry.update(record.args)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(level="INFO", path=None, capacity=1000):
+    """
+    Sends the run log to stdout and, optionally, a JSON Lines file, through buffers.
+
+    Notes
+    -----
+    Records are held in memory and written in batches of `capacity`, or at
+    once from a warning up. A record below `level` costs one level check, so
+    debug records can stay in the per-move loop.
+
+    Parameters
+    ----------
+    level : str or int
+        Lowest level logged, "DEBUG" to log every move.
+    path : str or Path, optional
+        Path of the JSON Lines file.
+    capacity : int
+        Number of records held before they are written.
+
+    Returns
+    -------
+    None
+
+    """
+    # Handlers left over from an earlier run in the same process
+    for handler in list(logger.handlers):
+        handler.close()
+        logger.removeHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter("%(message)s"))
+    sinks = [console]
+    if path:
+        log_file = logging.FileHandler(str(path), mode="w")
+        log_file.setFormatter(JsonFormatter())
+        sinks.append(log_file)
+    for sink in sinks:
+        logger.addHandler(
+            logging.handlers.MemoryHandler(
+                capacity, flushLevel=logging.WARNING, target=sink
+            )
+        )
+
+
+def close_logs():
+    """
+    Writes out the records held in the log buffers and closes the log.
+    """
+    for handler in list(logger.handlers):
+        target = handler.target
+        handler.close()
+        target.close()
+        logger.removeHandler(handler)
+
+
+def summary_table(amount_added, positions_added):
+    """
+    Table of the amount and substances added to each well.
+
+    Parameters
+    ----------
+    amount_added : dict
+        Amount added to each well, keyed by well name. (in uL)
+    positions_added : dict
+        Substances added to each well, keyed by well name.
+
+    Returns
+    -------
+    str
+        One line per well, in the order the wells were filled.
+
+    """
+    lines = [f"{'Well':<8}{'Added (uL)':>12}  Substances"]
+    for location in dict.fromkeys(list(amount_added) + list(positions_added)):
+        lines.append(
+            f"{location:<8}{amount_added.get(location, 0):>12g}  "
+            f"{positions_added.get(location, '').strip()}"
+        )
+    return "\n".join(lines)
+
+
+def well_area(well):
+    """
+    Cross-section of a well from its labware geometry. (in mm^2)
+    """
+    if well.diameter:
+        return np.pi * (well.diameter / 2) ** 2
+    return well.length * well.width
+
+
+class SourceInventory:
+    """
+    Volume ledger of the source wells on the deck.
+
+    Notes
+    -----
+    Every source well is one row of the arrays below, in deck order. With the
+    "sequential" policy the wells of a substance are drawn from one after
+    another; a cursor per substance points at the well currently in use, so
+    finding a source never scans the wells that are already used up. The
+    "nearest" policy draws from the well closest to the destination and the
+    "balanced" policy from the well with the most volume left.
+
+    Attributes
+    ----------
+    substance : numpy.ndarray
+        Substance id of each well, indexing `names`.
+    slot : numpy.ndarray
+        Deck slot of each well.
+    well : numpy.ndarray
+        Well name of each well.
+    volume : numpy.ndarray
+        Volume left in each well. (in uL)
+    initial : numpy.ndarray
+        Volume each well was filled with. (in uL)
+    capacity : numpy.ndarray
+        Volume each well can hold. (in uL)
+    reserve : numpy.ndarray
+        Volume that must stay in each well after drawing from it. (in uL)
+    area : numpy.ndarray
+        Cross-section of each well. (in mm^2)
+    positions : list
+        Labware well of each row.
+    points : numpy.ndarray
+        Deck coordinates (x, y) of each well. (in mm)
+    travel : numpy.ndarray
+        Distance from the chosen source wells to their destinations, and from
+        the wells drawing in deck order would have chosen. (in mm)
+    demand : numpy.ndarray
+        Volume of each substance the moves still to be made draw, indexing
+        like `names`. (in uL)
+    """
+
+    def __init__(
+        self,
+        labware,
+        deck_info,
+        minimum_volume,
+        immersion_depth=None,
+        bottom_clearance=1,
+        policy="sequential",
+    ):
+        """
+        Initialise the inventory from the deck information.
+
+        Parameters
+        ----------
+        labware : dict
+            Loaded labware, keyed by deck slot.
+        deck_info : dict
+            Wells of each deck slot with their substance and amount.
+        minimum_volume : float, int or dict
+            Volume that must stay in a well after drawing from it, or a dict
+            of such volumes keyed by deck slot. (in uL)
+        immersion_depth : float or int, optional
+            Depth below the liquid surface to aspirate from. When given, the
+            liquid height is tracked and the volume kept in each well is what
+            its shape needs instead of `minimum_volume`. (in mm)
+        bottom_clearance : float or int
+            Lowest height above the well bottom to aspirate from. (in mm)
+        policy : str
+            How to choose among the wells holding a substance: "sequential",
+            "nearest" or "balanced".
+
+        Returns
+        -------
+        None
+        """
+        if policy not in ("sequential", "nearest", "balanced"):
+            raise ValueError(f"Unknown source policy {policy!r}.")
+        self.policy = policy
+        self.travel = np.zeros(2)
+        self.minimum_volume = minimum_volume
+        self.immersion_depth = immersion_depth
+        self.bottom_clearance = bottom_clearance
+        self.names = []
+        self.ids = {}
+        substances, slots, wells, volumes = [], [], [], []
+        self.positions = []
+        for position in deck_info:
+            position_int = int(position)
+            for well_plate, substance in deck_info[position].items():
+                if well_plate in ("name", "type"):
+                    continue
+                substance_name = substance["substance"]
+                if substance_name not in self.ids:
+                    self.ids[substance_name] = len(self.names)
+                    self.names.append(substance_name)
+                substances.append(self.ids[substance_name])
+                slots.append(position_int)
+                wells.append(well_plate)
+                volumes.append(substance["amount"])
+                self.positions.append(labware[position_int][well_plate])
+        self.substance = np.array(substances, dtype=np.int64)
+        self.slot = np.array(slots, dtype=np.int64)
+        self.well = np.array(wells, dtype=object)
+        self.volume = np.array(volumes, dtype=float)
+        self.initial = self.volume.copy()
+        self.capacity = np.maximum(
+            [float(well.max_volume) for well in self.positions], self.initial
+        )
+        self.area = np.array([well_area(well) for well in self.positions], dtype=float)
+        self.points = np.array(
+            [well_point(well) for well in self.positions], dtype=float
+        ).reshape(-1, 2)
+        if immersion_depth is None and isinstance(minimum_volume, dict):
+            self.reserve = np.array(
+                [float(minimum_volume[str(slot)]) for slot in slots], dtype=float
+            )
+        elif immersion_depth is None:
+            self.reserve = np.full(len(self.positions), float(minimum_volume))
+        else:
+            # Liquid needed for the tip to stay immersed above the bottom clearance
+            self.reserve = self.area * (bottom_clearance + immersion_depth)
+        # Rows of each substance, grouped by substance id and in deck order
+        self.rows = np.argsort(self.substance, kind="stable")
+        counts = np.bincount(self.substance, minlength=len(self.names))
+        self.start = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+        self.end = self.start + counts
+        self.cursor = self.start.copy()
+        self.demand = np.zeros(len(self.names))
+        # Row of each well, keyed by deck slot and well name
+        self.index = {(slot, well): row for row, (slot, well) in enumerate(zip(slots, wells))}
+
+    def substance_at(self, slot, well_name):
+        """
+        Name of the substance in a well, looked up by deck slot and well name.
+        """
+        if (slot, well_name) not in self.index:
+            raise RuntimeError(f"No substance in {well_name} on slot {slot}.")
+        return self.names[self.substance[self.index[(slot, well_name)]]]
+
+    def __contains__(self, substance_name):
+        return substance_name in self.ids
+
+    def source(self, substance_name, amount, near=None):
+        """
+        Finds the well to draw an amount of substance from.
+
+        Parameters
+        ----------
+        substance_name : str
+            Name of the substance to be moved.
+        amount : float or int
+            Amount of substance to be drawn. (in uL)
+        near : tuple, optional
+            Deck coordinates (x, y) of the destination. (in mm)
+
+        Returns
+        -------
+        int
+            Row of the source well.
+        """
+        if substance_name not in self.ids:
+            raise RuntimeError(f"Substance {substance_name} not found in deck.")
+        substance_id = self.ids[substance_name]
+        if self.policy != "sequential":
+            return self.choose(substance_name, amount, near)
+        cursor = self.cursor[substance_id]
+        end = self.end[substance_id]
+        while cursor < end:
+            row = self.rows[cursor]
+            if amount <= self.volume[row] - self.reserve[row]:
+                self.cursor[substance_id] = cursor
+                return row
+            logger.info(
+                "Amount of %s needed is greater than the amount in %s on slot %s. "
+                "Changing the well plate to move from.",
+                substance_name,
+                self.well[row],
+                self.slot[row],
+            )
+            cursor += 1
+        self.cursor[substance_id] = cursor
+        raise RuntimeError(
+            f"No more {substance_name} left on the deck. Please check the deck and try again."
+        )
+
+    def choose(self, substance_name, amount, near=None):
+        """
+        Picks a source well by the "nearest" or "balanced" policy.
+
+        Notes
+        -----
+        Only wells that keep their reserve after the draw are candidates. Ties
+        go to the first well in deck order, which is also what the nearest
+        policy falls back to without a destination.
+        """
+        substance_id = self.ids[substance_name]
+        rows = self.rows[self.cursor[substance_id]:self.end[substance_id]]
+        rows = rows[self.volume[rows] - self.reserve[rows] >= amount]
+        if len(rows) == 0:
+            raise RuntimeError(
+                f"No more {substance_name} left on the deck. Please check the deck and try again."
+            )
+        if near is None:
+            return rows[0]
+        distance = np.hypot(*(self.points[rows] - near).T)
+        if self.policy == "nearest":
+            chosen = int(np.argmin(distance))
+        else:
+            chosen = int(np.argmax(self.volume[rows] - self.reserve[rows]))
+        self.travel += (distance[chosen], distance[0])
+        return rows[chosen]
+
+    def exhausted(self, substance_name, amount):
+        """
+        Whether none of the wells still in use can give an amount of substance.
+        """
+        substance_id = self.ids[substance_name]
+        rows = self.rows[self.cursor[substance_id]:self.end[substance_id]]
+        return not np.any(self.volume[rows] - self.reserve[rows] >= amount)
+
+    def refill(self, row, amount):
+        """
+        Adds an amount of substance to a source well and draws from it again.
+        """
+        self.volume[row] += amount
+        substance_id = self.substance[row]
+        position = int(np.flatnonzero(self.rows == row)[0])
+        self.cursor[substance_id] = min(self.cursor[substance_id], position)
+
+    def plan_refill(self, substance_name, amount):
+        """
+        Volumes to refill the wells of a substance with for the rest of the run.
+
+        Notes
+        -----
+        The wells are filled in deck order, each up to its capacity at most,
+        until they hold what the moves still to be made draw. Each well is
+        given room for one extra transfer, as a transfer too large for what
+        is left in a well is drawn from the next one.
+
+        Parameters
+        ----------
+        substance_name : str
+            Name of the substance that has run out.
+        amount : float or int
+            Amount of substance the next transfer draws. (in uL)
+
+        Returns
+        -------
+        list of tuple of int and float
+            Row of each well to refill and the volume to add to it. (in uL)
+        """
+        substance_id = self.ids[substance_name]
+        shortfall = max(
+            self.demand[substance_id] - self.available(substance_name), amount
+        )
+        refills = []
+        for row in self.rows[self.start[substance_id]:self.end[substance_id]]:
+            if shortfall <= 0:
+                break
+            volume = min(self.capacity[row] - self.volume[row], shortfall + amount)
+            # A well that cannot give the next transfer even when full is left
+            if self.volume[row] + volume - self.reserve[row] < amount:
+                continue
+            refills.append((row, float(volume)))
+            shortfall -= volume - amount
+        return refills
+
+    def first(self, substance_name):
+        """
+        Row of the first well of a substance, in deck order.
+        """
+        return self.rows[self.start[self.ids[substance_name]]]
+
+    def current(self, substance_name):
+        """
+        Row of the well a substance is currently drawn from.
+        """
+        substance_id = self.ids[substance_name]
+        cursor = min(self.cursor[substance_id], self.end[substance_id] - 1)
+        return self.rows[cursor]
+
+    def aspirate_location(self, row, amount):
+        """
+        Location to aspirate an amount from, following the liquid height.
+
+        Notes
+        -----
+        The tip goes `immersion_depth` below where the surface will be once the
+        amount is drawn, so it stays in the liquid for the whole aspiration.
+        Without height tracking this is the well itself, which aspirates at
+        the pipette's default bottom clearance.
+        """
+        well = self.positions[row]
+        if self.immersion_depth is None:
+            return well
+        height = (self.volume[row] - amount) / self.area[row] - self.immersion_depth
+        return well.bottom(max(float(height), self.bottom_clearance))
+
+    def draw(self, row, amount):
+        """
+        Removes an amount of substance from a source well.
+        """
+        self.volume[row] -= amount
+        self.demand[self.substance[row]] -= amount
+
+    def remaining(self, substance_name):
+        """
+        Volume of a substance left in its wells that are still in use. (in uL)
+        """
+        substance_id = self.ids[substance_name]
+        rows = self.rows[self.cursor[substance_id]:self.end[substance_id]]
+        return float(self.volume[rows].sum())
+
+    def available(self, substance_name):
+        """
+        Volume of a substance that can be drawn above the well reserves. (in uL)
+        """
+        return float(self.headroom(substance_name).sum())
+
+    def headroom(self, substance_name):
+        """
+        Volume above the reserve of each well of a substance still in use. (in uL)
+        """
+        substance_id = self.ids[substance_name]
+        rows = self.rows[self.cursor[substance_id]:self.end[substance_id]]
+        return np.clip(self.volume[rows] - self.reserve[rows], 0, None)
+
+    def report(self):
+        """
+        Volume left in each source well, grouped by substance.
+        """
+        return {
+            substance_name: {
+                f"{self.slot[row]}:{self.well[row]}": float(self.volume[row])
+                for row in self.rows[self.start[substance_id]:self.end[substance_id]]
+            }
+            for substance_name, substance_id in self.ids.items()
+        }
+
+
+class TipState:
+    """
+    Wetting history of the tip currently on a pipette.
+
+    Attributes
+    ----------
+    wetted : dict
+        Time each substance last wetted the tip, keyed by substance name. (in s)
+    """
+
+    def __init__(self):
+        self.wetted = {}
+
+    def wet(self, substance_name, now):
+        """
+        Records that the tip has been in contact with a substance.
+        """
+        self.wetted[substance_name] = now
+
+    def is_wet(self, substance_name, now, lasts):
+        """
+        Whether the tip is still wetted with a substance.
+        """
+        if substance_name not in self.wetted:
+            return False
+        return lasts is None or now - self.wetted[substance_name] <= lasts
+
+
+class Journal:
+    """
+    Append-only record of the transfers and tip pick-ups of a run.
+
+    Notes
+    -----
+    One JSON line is written after every completed transfer, tip pick-up and
+    refill, and a distributing trip writes one after each of its dispenses.
+    When resuming, the transfers and refills already in the journal are
+    replayed into the ledger in place of being pipetted again, so a trip cut
+    short only goes on to the wells it had not reached, and the tip racks
+    carry on from the first unused tip. A line cut short by a crash is
+    dropped.
+
+    Attributes
+    ----------
+    transfers : list of dict
+        Transfers recorded by the run being resumed, in order.
+    refills : list of dict
+        Refills recorded by the run being resumed, in order.
+    tips_used : dict
+        Tips picked up by the run being resumed, keyed by pipette mount.
+    step : int
+        Number of transfers made or replayed so far.
+    """
+
+    def __init__(self, path=None, resume=False, write=True):
+        """
+        Initialise the journal.
+
+        Parameters
+        ----------
+        path : str or Path, optional
+            Path of the journal file. Nothing is recorded without one.
+        resume : bool
+            Carry on from the journal at `path` instead of starting afresh.
+        write : bool
+            Whether to write to the journal, off while simulating so that
+            analysing the protocol does not overwrite a run's journal.
+
+        Returns
+        -------
+        None
+        """
+        self.transfers = []
+        self.refills = []
+        self.tips_used = defaultdict(lambda: 0)
+        self.step = 0
+        self.file = None
+        if path is None:
+            return
+        if resume and Path(path).is_file():
+            # Length of the journal up to the last complete line
+            length = 0
+            with open(str(path), "rb") as f:
+                for text in f:
+                    if not text.endswith(b"\n"):
+                        break
+                    record = json.loads(text)
+                    if "tip" in record:
+                        self.tips_used[record["tip"]] += 1
+                    elif "refill" in record:
+                        self.refills.append(record)
+                    else:
+                        self.transfers.append(record)
+                    length += len(text)
+            if write:
+                os.truncate(str(path), length)
+        if write:
+            self.file = open(str(path), "a" if resume else "w", buffering=1)
+
+    def replay(self, ot, substance_name, pipette):
+        """
+        Applies the next recorded transfer to the ledger, if there is one.
+
+        Parameters
+        ----------
+        ot : Opentrons
+            The Opentrons object holding the substance ledger.
+        substance_name : str
+            Name of the substance the plan moves next.
+        pipette : pipette
+            The pipette to be used.
+
+        Returns
+        -------
+        bool
+            Whether the transfer was already done and has been replayed.
+        """
+        # Refills made before this transfer
+        while self.refills and self.refills[0]["step"] == self.step:
+            record = self.refills.pop(0)
+            ot.substances.refill(
+                ot.substances.index[tuple(record["refill"])], record["amount"]
+            )
+        if self.step >= len(self.transfers):
+            return False
+        record = self.transfers[self.step]
+        if record["substance"] != substance_name:
+            raise RuntimeError(
+                f"The journal does not match this plan at transfer {self.step}: "
+                f"expected {substance_name}, found {record['substance']}."
+            )
+        row = ot.substances.index[tuple(record["source"])]
+        ot.substances.draw(row, record["amount"])
+        self.step += 1
+        return True
+
+    def record_transfer(self, substance_name, slot, well_name, amount):
+        """
+        Records a completed transfer.
+        """
+        self.step += 1
+        if self.file is not None:
+            self.file.write(
+                json.dumps(
+                    {
+                        "step": self.step - 1,
+                        "substance": substance_name,
+                        "source": [int(slot), str(well_name)],
+                        "amount": float(amount),
+                    }
+                )
+                + "\n"
+            )
+
+    def record_refill(self, slot, well_name, amount):
+        """
+        Records a source well refilled before the next transfer.
+        """
+        if self.file is not None:
+            self.file.write(
+                json.dumps(
+                    {
+                        "step": self.step,
+                        "refill": [int(slot), str(well_name)],
+                        "amount": float(amount),
+                    }
+                )
+                + "\n"
+            )
+
+    def record_tip(self, pipette):
+        """
+        Records a tip pick-up.
+        """
+        if self.file is not None:
+            self.file.write(json.dumps({"tip": pipette.mount}) + "\n")
+
+    def close(self):
+        """
+        Closes the journal file.
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class StockDatabase:
+    """
+    Volume left in each source well, kept in an SQLite database from one run
+    to the next.
+
+    Notes
+    -----
+    Each well is one row keyed by deck slot and well name, with its substance
+    and the time it was last written; a second index on the substance finds
+    where a substance is kept. The ledger is seeded from the wells whose
+    substance matches the deck information and written back once the run
+    has finished, so an aborted run leaves the volumes it started from, as a
+    resumed run expects.
+    """
+
+    def __init__(self, path=None, write=True):
+        """
+        Initialise the database.
+
+        Parameters
+        ----------
+        path : str or Path, optional
+            Path of the database file. Nothing is kept without one.
+        write : bool
+            Whether to write to the database, off while simulating so that
+            analysing the protocol does not use up stock.
+
+        Returns
+        -------
+        None
+        """
+        self.write = write
+        self.connection = None
+        if path is None:
+            return
+        if write:
+            self.connection = sqlite3.connect(str(path))
+            with self.connection:
+                self.connection.execute(
+                    "CREATE TABLE IF NOT EXISTS stock ("
+                    "slot INTEGER NOT NULL, well TEXT NOT NULL, substance TEXT NOT NULL, "
+                    "amount REAL NOT NULL, updated TEXT NOT NULL, PRIMARY KEY (slot, well))"
+                )
+                self.connection.execute(
+                    "CREATE INDEX IF NOT EXISTS stock_substance ON stock (substance)"
+                )
+        elif Path(path).is_file():
+            self.connection = sqlite3.connect(f"file:{Path(path).as_posix()}?mode=ro", uri=True)
+
+    def seed(self, substances, corrections=None):
+        """
+        Sets the ledger to the volumes left by the last run.
+
+        Parameters
+        ----------
+        substances : SourceInventory
+            The ledger of the source wells on the deck.
+        corrections : dict, optional
+            Volumes measured or topped up by hand, overriding the database, as
+            {slot: {well name: amount}}. (in uL)
+
+        Returns
+        -------
+        int
+            Number of wells seeded from the database.
+
+        Raises
+        ------
+        RuntimeError
+            If a correction names a well that holds no substance.
+        """
+        seeded = 0
+        slots = sorted(set(int(slot) for slot in substances.slot))
+        if self.connection is not None and slots:
+            rows = self.connection.execute(
+                "SELECT slot, well, substance, amount FROM stock "
+                f"WHERE slot IN ({', '.join('?' * len(slots))})",
+                slots,
+            )
+            for slot, well_name, substance_name, amount in rows:
+                row = substances.index.get((slot, well_name))
+                # A well now holding another substance starts from the deck information
+                if row is None or substances.names[substances.substance[row]] != substance_name:
+                    continue
+                substances.volume[row] = amount
+                seeded += 1
+        for slot, wells in (corrections or {}).items():
+            for well_name, amount in wells.items():
+                row = substances.index.get((int(slot), well_name))
+                if row is None:
+                    raise RuntimeError(f"No substance in {well_name} on slot {slot} to correct.")
+                substances.volume[row] = amount
+        return seeded
+
+    def save(self, substances):
+        """
+        Writes the volume left in each source well on the deck.
+        """
+        if self.connection is None or not self.write:
+            return
+        updated = time.strftime("%Y-%m-%dT%H:%M:%S")
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO stock (slot, well, substance, amount, updated) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    (
+                        int(substances.slot[row]),
+                        str(substances.well[row]),
+                        substances.names[substances.substance[row]],
+                        float(substances.volume[row]),
+                        updated,
+                    )
+                    for row in range(len(substances.volume))
+                ),
+            )
+
+    def close(self):
+        """
+        Closes the connection to the database.
+        """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class TipInventory:
+    """
+    Tips used from each tip rack, kept in a JSON file from one run to the next.
+
+    Notes
+    -----
+    Tips are taken from each rack in order, so a rack is recorded as its type
+    and the number of tips used from it, keyed by deck slot. A rack counts as
+    full when the rack recorded on its slot is of another type, or once it has
+    been replaced. The file is rewritten after every tip pick-up.
+
+    Attributes
+    ----------
+    racks : dict
+        Type and number of tips used of each tip rack, keyed by deck slot.
+    """
+
+    def __init__(self, path=None, write=True):
+        """
+        Initialise the tip inventory.
+
+        Parameters
+        ----------
+        path : str or Path, optional
+            Path of the inventory file. Every rack starts full without one.
+        write : bool
+            Whether to write to the inventory file, off while simulating so
+            that analysing the protocol does not use up tips.
+
+        Returns
+        -------
+        None
+        """
+        self.path = path
+        self.write = write and path is not None
+        self.racks = {}
+        if path is not None and Path(path).is_file():
+            with open(str(path)) as f:
+                self.racks = json.load(f)
+
+    def load(self, slot, tip_rack):
+        """
+        Registers a tip rack loaded on the deck.
+        """
+        record = self.racks.get(str(slot))
+        if record is None or record["type"] != tip_rack.load_name:
+            self.racks[str(slot)] = {"type": tip_rack.load_name, "used": 0}
+
+    def free(self, pipette, replace_empty=False):
+        """
+        Number of unused tips in the tip racks of a pipette, counting the
+        empty racks as full if they are to be replaced.
+        """
+        free = 0
+        for slot, tip_rack in zip(pipette.tip_rack_slots, pipette.tip_racks):
+            tips = len(tip_rack.wells())
+            used = self.racks[str(slot)]["used"]
+            free += tips if replace_empty and used >= tips else tips - used
+        return free
+
+    def skip(self, pipette, count):
+        """
+        Marks the next tips of a pipette as used without picking them up.
+        """
+        for slot, tip_rack in zip(pipette.tip_rack_slots, pipette.tip_racks):
+            record = self.racks[str(slot)]
+            skipped = min(count, len(tip_rack.wells()) - record["used"])
+            record["used"] += skipped
+            count -= skipped
+        self.save()
+
+    def take(self, pipette):
+        """
+        The next unused tip of a pipette, recorded as used.
+
+        Notes
+        -----
+        Racks already started are used up before full ones.
+
+        Parameters
+        ----------
+        pipette : pipette
+            The pipette to be used.
+
+        Returns
+        -------
+        well
+            The tip to pick up.
+
+        Raises
+        ------
+        RuntimeError
+            If the tip racks of the pipette are empty.
+        """
+        racks = [
+            (self.racks[str(slot)], tip_rack.wells())
+            for slot, tip_rack in zip(pipette.tip_rack_slots, pipette.tip_racks)
+            if self.racks[str(slot)]["used"] < len(tip_rack.wells())
+        ]
+        if not racks:
+            raise RuntimeError(f"The tip racks of the {pipette.mount} pipette are empty.")
+        record, tips = max(racks, key=lambda rack: rack[0]["used"])
+        record["used"] += 1
+        self.save()
+        return tips[record["used"] - 1]
+
+    def replace(self, slot):
+        """
+        Records a tip rack replaced by a full one.
+        """
+        self.racks[str(slot)]["used"] = 0
+        self.save()
+
+    def empty(self, pipettes):
+        """
+        Deck slots of the tip racks of the pipettes with no tips left.
+        """
+        return [
+            slot
+            for pipette in pipettes
+            for slot, tip_rack in zip(pipette.tip_rack_slots, pipette.tip_racks)
+            if self.racks[str(slot)]["used"] >= len(tip_rack.wells())
+        ]
+
+    def save(self):
+        """
+        Writes the inventory file, replacing it in one step.
+        """
+        if not self.write:
+            return
+        temporary = Path(str(self.path) + ".tmp")
+        with open(str(temporary), "w") as f:
+            json.dump(self.racks, f, indent=4)
+        os.replace(str(temporary), str(self.path))
+
+
+class Trace:
+    """
+    Timeline of the steps of a run.
+
+    Notes
+    -----
+    Each step is a span with its start and end time and its attributes. Spans
+    nest, so a transfer holds its tip change, swelling and liquid handling.
+    Times are taken from the host clock, so a simulated run shows the time
+    spent planning rather than on the robot.
+
+    Attributes
+    ----------
+    spans : list of dict
+        Finished spans, in the order they ended.
+    enabled : bool
+        Whether spans are kept, off when there is nowhere to export them.
+    """
+
+    def __init__(self, enabled=True):
+        self.spans = []
+        self.enabled = enabled
+        self.start = time.monotonic()
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        Times a step, yielding its attributes so they can be filled in as it runs.
+        """
+        if not self.enabled:
+            yield attributes
+            return
+        start = time.monotonic()
+        try:
+            yield attributes
+        finally:
+            self.spans.append(
+                {
+                    "name": name,
+                    "start": start - self.start,
+                    "end": time.monotonic() - self.start,
+                    "attributes": attributes,
+                }
+            )
+
+    def export(self, trace_path=None, log_path=None):
+        """
+        Writes the spans as a Chrome trace and as JSON Lines.
+
+        Parameters
+        ----------
+        trace_path : str or Path, optional
+            Path of the Chrome trace, for chrome://tracing or Perfetto.
+        log_path : str or Path, optional
+            Path of the JSON Lines file, one span per line in start order.
+
+        Returns
+        -------
+        None
+
+        """
+        spans = sorted(self.spans, key=lambda span: (span["start"], -span["end"]))
+        if trace_path:
+            events = [
+                {
+                    "name": span["name"],
+                    "cat": "protocol",
+                    "ph": "X",
+                    "ts": span["start"] * 1e6,
+                    "dur": (span["end"] - span["start"]) * 1e6,
+                    "pid": 1,
+                    "tid": 1,
+                    "args": span["attributes"],
+                }
+                for span in spans
+            ]
+            with open(str(trace_path), "w") as f:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        if log_path:
+            with open(str(log_path), "w") as f:
+                for span in spans:
+                    f.write(json.dumps(span) + "\n")
+
+
+class ProtocolClock:
+    """
+    Modelled time of a run, for timing the steps that depend on the robot's time.
+
+    Notes
+    -----
+    Delays return at once while a protocol is analysed, so the host clock
+    does not tell how long the robot has been working. The clock is instead
+    advanced by the commands given, as the estimator does: the delays, the
+    gantry travel between wells, lifting to clear the labware on each move,
+    the liquid handled at the pipette's flow rates and the tip commands.
+
+    Attributes
+    ----------
+    now : float
+        Time since the start of the run. (in s)
+    position : tuple or None
+        Deck coordinates (x, y) of the gantry. (in mm)
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.position = None
+
+    def wait(self, seconds):
+        """
+        Advances the clock by a delay or the time of a command.
+        """
+        self.now += seconds
+
+    def move(self, location):
+        """
+        Advances the clock by the travel to a well or location.
+        """
+        if hasattr(location, "top"):
+            location = location.top()
+        point = (location.point.x, location.point.y)
+        if self.position is not None and point != self.position:
+            x, y = self.position
+            self.now += hypot(point[0] - x, point[1] - y) / clock_model["gantry_speed"]
+            self.now += 2 * clock_model["lift"] / clock_model["z_speed"]
+        self.position = point
+
+
+class Opentrons:
+    def __init__(
+        self,
+        protocol: protocol_api.ProtocolContext,
+        deck_info: dict,
+    ):
+        """
+        Initialise the Opentrons object.
+
+        Parameters
+        ----------
+        protocol : protocol_api.ProtocolContext
+            The protocol context for the current protocol.
+        deck_info : dict
+            Dictionary of deck information.
+            Contains information of substances and their quantities on the deck.
+
+        Returns
+        -------
+        None
+        """
+        # Set gantry speeds
+        self.protocol = protocol
+        # self.protocol.max_speeds["X"] = 100
+        # self.protocol.max_speeds["Y"] = 100
+        # self.protocol.max_speeds["Z"] = 100
+
+        self.plate = self.protocol.load_labware(
+            "aglient_54_wellplate_2000ul", run_options["plate_slot"]
+        )
+        self.labware = {}
+        self.labware[run_options["plate_slot"]] = self.plate
+        # Add substances to the deck
+        for deck_number in deck_info:
+            self.labware[int(deck_number)] = self.protocol.load_labware(
+                deck_info[deck_number]["type"], int(deck_number)
+            )
+        # Loading the tip racks and pipettes of the script
+        self.pipettes = load_pipettes(self)
+        # For carrying on from an aborted run
+        self.journal = Journal(
+            run_options["journal_path"],
+            resume=run_options["resume"],
+            write=not self.protocol.is_simulating(),
+        )
+        # For timing the tip wetting by the robot's time rather than the host's
+        self.clock = ProtocolClock()
+        # For timing each step of the run
+        self.trace = Trace(
+            enabled=bool(run_options["trace_path"] or run_options["trace_log_path"])
+        )
+        # For starting from the next unused tip of each rack
+        self.tips = TipInventory(
+            run_options["tip_inventory_path"],
+            write=not self.protocol.is_simulating(),
+        )
+        for pipette in self.pipettes:
+            pipette.tip_state = TipState()
+            pipette.tip_pending = False
+            for slot, tip_rack in zip(pipette.tip_rack_slots, pipette.tip_racks):
+                self.tips.load(slot, tip_rack)
+            # The inventory already counts the tips of the run being resumed
+            if run_options["tip_inventory_path"] is None:
+                self.tips.skip(pipette, self.journal.tips_used[pipette.mount])
+        # For reporting the swelling skipped by the tip rules
+        self.swells_skipped = 0
+        self.swell_time_saved = 0
+        # For reporting the commands dropped by optimise_handling
+        self.commands_saved = 0
+        self.handling_time_saved = 0
+        # For tracking substance amounts
+        self.substances = SourceInventory(
+            self.labware,
+            deck_info,
+            minimum_volume=run_options["minimum_volume"],
+            immersion_depth=(
+                run_options["immersion_depth"] if run_options["track_height"] else None
+            ),
+            bottom_clearance=run_options["bottom_clearance"],
+            policy=run_options["source_policy"],
+        )
+        # For carrying the volumes left over from one run to the next
+        self.stock = StockDatabase(
+            run_options["stock_path"], write=not self.protocol.is_simulating()
+        )
+        seeded = self.stock.seed(self.substances, run_options["stock_corrections"])
+        if seeded:
+            logger.info("Volumes of %d source wells carried over from the last run.", seeded)
+
+    def fresh_tip(self, pipette):
+        """
+        Picks up the new tip asked for by `change_tip`, dropping the old one.
+
+        Notes
+        -----
+        Tips are changed just before the next motion rather than when asked
+        for, so transfers replayed from the journal never use a tip.
+
+        Parameters
+        ----------
+        pipette : pipette
+            The pipette to be used.
+
+        Returns
+        -------
+        None
+
+        """
+        if not pipette.tip_pending:
+            return
+        if pipette.has_tip:
+            with self.trace.span("drop_tip", pipette=pipette.mount):
+                pipette.drop_tip()
+            self.clock.move(self.protocol.fixed_trash["A1"])
+            self.clock.wait(clock_model["drop_tip"])
+        tip = self.tips.take(pipette)
+        with self.trace.span("pick_up_tip", pipette=pipette.mount):
+            pipette.pick_up_tip(tip)
+        self.clock.move(tip)
+        self.clock.wait(clock_model["pick_up_tip"])
+        self.journal.record_tip(pipette)
+        pipette.tip_state = TipState()
+        pipette.tip_pending = False
+
+    def stock_tips(self, tips_needed):
+        """
+        Makes sure the tip racks hold enough tips for the plan before any motion.
+
+        Notes
+        -----
+        When the racks of a pipette have too few tips left, spare racks are
+        loaded on the free slots of `run_options["spare_tip_rack_slots"]`. If
+        there are still too few, the run pauses once for the empty racks to be
+        replaced. Either way the run does not stop for tips part way through.
+
+        Parameters
+        ----------
+        tips_needed : dict
+            Number of tips the plan needs, keyed by pipette mount.
+
+        Returns
+        -------
+        None
+
+        """
+        short = [
+            pipette
+            for pipette in self.pipettes
+            if self.tips.free(pipette) < tips_needed[pipette.mount]
+        ]
+        spare_slots = [
+            slot for slot in run_options["spare_tip_rack_slots"] if slot not in self.labware
+        ]
+        for pipette in short:
+            while spare_slots and (
+                self.tips.free(pipette, replace_empty=True) < tips_needed[pipette.mount]
+            ):
+                slot = spare_slots.pop(0)
+                tip_rack = self.protocol.load_labware(pipette.tip_racks[0].load_name, slot)
+                self.labware[slot] = tip_rack
+                pipette.tip_racks = pipette.tip_racks + [tip_rack]
+                pipette.tip_rack_slots.append(slot)
+                self.tips.load(slot, tip_rack)
+                logger.info(
+                    "Loaded a spare %s on slot %d for the %s pipette.",
+                    tip_rack.load_name,
+                    slot,
+                    pipette.mount,
+                )
+        short = [
+            pipette
+            for pipette in short
+            if self.tips.free(pipette) < tips_needed[pipette.mount]
+        ]
+        empty_racks = self.tips.empty(short)
+        if empty_racks:
+            self.protocol.pause(
+                f"Replace the empty tip racks on slot{'s' * (len(empty_racks) > 1)} "
+                f"{', '.join(map(str, empty_racks))} with full ones, then resume."
+            )
+            for slot in empty_racks:
+                self.tips.replace(slot)
+            logger.info("Tip racks on slots %s replaced.", empty_racks)
+
+    def skip_command(self, name, count=1, commands=1):
+        """
+        Counts commands dropped by `run_options["optimise_handling"]`.
+
+        Parameters
+        ----------
+        name : str
+            Kind of command dropped, a key of `command_time`.
+        count : int
+            Number of times it is dropped.
+        commands : int
+            Number of robot commands each one stands for.
+
+        Returns
+        -------
+        None
+
+        """
+        self.commands_saved += count * commands
+        self.handling_time_saved += count * command_time[name]
+
+    def count_merged(self, move, pipette, distribute, air_gap=0, blow_out=False):
+        """
+        Counts the trips or dispenses saved by the moves merged into a move.
+
+        Parameters
+        ----------
+        move : dict
+            Move made by `merge_moves`.
+        pipette : pipette
+            The pipette to be used.
+        distribute : bool
+            Whether the move is distributed, saving a dispense per merged move
+            rather than whole trips.
+        air_gap: float or int
+            Air gap drawn in after each aspiration. (in uL)
+        blow_out: bool
+            Whether each trip blows out in the destination.
+
+        Returns
+        -------
+        None
+
+        """
+        parts = move.get("merged", [])
+        if len(parts) < 2:
+            return
+        if distribute:
+            self.skip_command("dispense", len(parts) - 1)
+            return
+        trips = sum(len(plan_chunks(part, pipette, air_gap)) for part in parts)
+        merged_trips = len(plan_chunks(move["amount"], pipette, air_gap))
+        self.skip_command("trip", trips - merged_trips, commands=2)
+        if air_gap:
+            self.skip_command("air_gap", trips - merged_trips)
+        if blow_out:
+            self.skip_command("blow_out", trips - merged_trips)
+
+    def find_source(self, substance_name, amount, near=None):
+        """
+        Finds the well to draw an amount of substance from.
+
+        Notes
+        -----
+        With `run_options["refill"]`, a substance that has run out pauses the
+        run for a refill instead of raising, keeping the tip on the pipette.
+
+        Parameters
+        ----------
+        substance_name : str
+            Name of the substance to be moved.
+        amount : float or int
+            Amount of substance to be drawn. (in uL)
+        near : position, optional
+            Destination well, for the "nearest" source policy.
+
+        Returns
+        -------
+        int
+            Row of the source well.
+
+        """
+        if run_options["refill"] and self.substances.exhausted(substance_name, amount):
+            self.request_refill(substance_name, amount)
+        if near is not None:
+            near = well_point(near)
+        return self.substances.source(substance_name, amount, near)
+
+    def request_refill(self, substance_name, amount):
+        """
+        Pauses the run until the wells of a substance hold the rest of the run.
+
+        Notes
+        -----
+        The whole volume the moves still to be made draw is asked for at
+        once, spread over the wells of the substance as `plan_refill` does,
+        so the run pauses once per shortfall rather than once per well.
+
+        Parameters
+        ----------
+        substance_name : str
+            Name of the substance that has run out.
+        amount : float or int
+            Amount of substance the next transfer draws. (in uL)
+
+        Returns
+        -------
+        None
+
+        """
+        substances = self.substances
+        refills = substances.plan_refill(substance_name, amount)
+        if not refills:
+            raise RuntimeError(
+                f"{amount} uL of {substance_name} cannot be drawn from any of its wells "
+                f"even when full. Please check the deck and try again."
+            )
+        wells = ", ".join(
+            f"{substances.well[row]} on slot {substances.slot[row]} with {volume:.0f} uL"
+            for row, volume in refills
+        )
+        message = (
+            f"No more {substance_name} left on the deck. Please refill {wells} and "
+            f"resume the run."
+        )
+        logger.warning(message)
+        self.protocol.pause(message)
+        for row, volume in refills:
+            substances.refill(row, volume)
+            self.journal.record_refill(substances.slot[row], substances.well[row], volume)
+
+    def swell_tip(self, pipette, position):
+        """
+        Swells the tip in the `stock` labware location at a specified location.
+
+        Notes
+        -----
+        Perform before a pipette is used for transfer.
+
+        Parameters
+        ----------
+        pipette : pipette
+            The pipette to be used.
+
+        position:
+            Position to swell the tip in.
+
+        Returns
+        -------
+        None
+
+        """
+        with self.trace.span("swell_tip", pipette=pipette.mount, source=str(position)):
+            for i in range(1):
+                pipette.aspirate(pipette.options["swell_volume"], position)
+                self.protocol.delay(pipette.options["swell_delay"])
+                if run_options["optimise_handling"]:
+                    # The dispense moves back into the well anyway
+                    self.skip_command("move_to")
+                else:
+                    pipette.move_to(position.top())
+                pipette.dispense(pipette.options["swell_volume"], location=position)
+                self.clock.move(position)
+                self.clock.wait(
+                    pipette.options["swell_delay"]
+                    + 2 * pipette.options["swell_volume"] / pipette.flow_rate.aspirate
+                )
+
+    def prepare_tip(self, pipette, substance_name, position):
+        """
+        Swells the tip in a substance unless the tip rules say it is not needed.
+
+        Notes
+        -----
+        A substance listed in `pipette.options["swell_rules"]` without "prewet" is
+        never swelled, and a tip is not swelled again while it is still wet
+        from its last contact with the substance, timed by `ProtocolClock`.
+
+        Parameters
+        ----------
+        pipette : pipette
+            The pipette to be used.
+        substance_name : str
+            Name of the substance to be moved.
+        position:
+            Position to swell the tip in.
+
+        Returns
+        -------
+        None
+
+        """
+        rule = pipette.options["swell_rules"].get(
+            substance_name, pipette.options["swell_default"]
+        )
+        # The tip dries on its way back to the source
+        self.clock.move(position)
+        now = self.clock.now
+        if pipette.tip_state.is_wet(substance_name, now, rule["lasts"]):
+            return
+        if rule["prewet"]:
+            self.swell_tip(pipette=pipette, position=position)
+        elif substance_name not in pipette.tip_state.wetted:
+            self.swells_skipped += 1
+            self.swell_time_saved += pipette.options["swell_delay"] + (
+                2 * pipette.options["swell_volume"] / pipette.flow_rate.aspirate
+            )
+        pipette.tip_state.wet(substance_name, now)
+
+    def move_without_drip(
+        self, position_to, position_from, pipette, amount, air_gap=True, blow_out=True
+    ):
+        """
+        Transfers substance from one location to another without dripping (hopefully).
+
+        Notes
+        -----
+        Ideally, the swell function will be used before this function is called to reduce the
+        probability of drips.
+
+        Parameters
+        ----------
+        position_to: position
+            Location of the target well plates to move substance to.
+        position_from: position
+            Location of the source well plates to move substance from.
+        amount: float or int
+            Amount of substance to be moved. (in uL)
+        air_gap: bool
+            Whether to draw the air gap set in the run options.
+        blow_out: bool
+            Whether to blow out, if the run options ask for it.
+
+        Returns
+        -------
+        None
+
+        """
+        with self.trace.span(
+            "move_without_drip",
+            pipette=pipette.mount,
+            source=str(position_from),
+            destination=str(position_to),
+            volume=float(amount),
+        ):
+            # Check if pipette swelled before movement
+            pipette.aspirate(amount, position_from)
+            volume = amount
+            if pipette.options["air_gap"] and air_gap:
+                pipette.air_gap(pipette.options["air_gap"])
+                volume += pipette.options["air_gap"]
+            elif pipette.options["air_gap"]:
+                self.skip_command("air_gap")
+            pipette.dispense(location=position_to.top(z=2))
+            self.clock.move(position_from)
+            self.clock.wait(volume / pipette.flow_rate.aspirate)
+            self.clock.move(position_to)
+            self.clock.wait(volume / pipette.flow_rate.dispense)
+            if pipette.options["blow_out"] and blow_out:
+                pipette.blow_out(position_to)
+                self.clock.wait(command_time["blow_out"])
+            elif pipette.options["blow_out"]:
+                self.skip_command("blow_out")
+
+    def move_substance(
+        self, amount, substance_name, position_to, pipette, chunk=0, last_chunk=True
+    ):
+        """
+        Moves a specified amount of substance from one location to another.
+
+        Parameters
+        ----------
+        amount : float or int
+            Amount of substance to be moved. (in mL)
+        substance_name : str
+            Name of the substance to be moved.
+        position_to: position
+            Location of the target well plates to move substance to.
+        pipette: pipette
+            The pipette to be used.
+        chunk: int
+            Index of this trip among the trips of the move, for the trace.
+        last_chunk: bool
+            Whether this is the last trip of the move.
+
+        Returns
+        -------
+        None
+
+        """
+        if self.journal.replay(self, substance_name, pipette):
+            return
+        with self.trace.span(
+            "move_substance",
+            pipette=pipette.mount,
+            substance=substance_name,
+            destination=str(position_to),
+            volume=float(amount),
+            chunk=chunk,
+        ) as span:
+            self.fresh_tip(pipette)
+            # Find the deck location of the substance
+            if substance_name not in self.substances:
+                logger.error(
+                    "Substance %(substance)s not found. Volumes left: %(volumes)s",
+                    {"substance": substance_name, "volumes": self.substances.report()},
+                )
+                raise RuntimeError(
+                    f"Substance not found in deck. This could be due to the deck being empty, or the amount of {substance_name} needed exceeding the amount placed on the deck."
+                )
+            source = self.find_source(substance_name, amount, near=position_to)
+            substance_position = self.substances.positions[source]
+            span["source"] = f"{self.substances.slot[source]}:{self.substances.well[source]}"
+
+            # Perform swelling
+            self.prepare_tip(pipette, substance_name, substance_position)
+            # Follow the liquid height so the tip stays just below the surface
+            aspirate_loc = self.substances.aspirate_location(source, amount)
+            # Trimmed handling keeps the air gap for volatile substances and
+            # blows out only after the last trip into the well
+            optimise = run_options["optimise_handling"]
+            self.move_without_drip(
+                pipette=pipette,
+                position_to=position_to,
+                position_from=aspirate_loc,
+                amount=amount,
+                air_gap=not optimise or substance_name in run_options["volatile"],
+                blow_out=not optimise or last_chunk,
+            )
+            pipette.tip_state.wet(substance_name, self.clock.now)
+            self.substances.draw(source, amount)
+            self.journal.record_transfer(
+                substance_name, self.substances.slot[source], self.substances.well[source], amount
+            )
+
+    def distribute_substance(
+        self, amounts, substance_name, positions_to, pipette, disposal_volume=0
+    ):
+        """
+        Moves substance from one source well into several wells with a single aspiration.
+
+        Notes
+        -----
+        The disposal volume stays in the tip while dispensing and is blown back
+        into the source well, so only the dispensed amounts leave the ledger.
+        The air gap of `distribution_air_gap` is drawn again after each
+        dispense while liquid is left in the tip, so it does not drip.
+        Each dispense is journalled as a transfer of its own; on resuming, the
+        dispenses already made are replayed and the trip aspirates only for
+        the wells left.
+
+        Parameters
+        ----------
+        amounts : list of float or int
+            Amount of substance to be dispensed into each well. (in uL)
+        substance_name : str
+            Name of the substance to be moved.
+        positions_to: list of position
+            Locations of the target wells, in dispensing order.
+        pipette: pipette
+            The pipette to be used.
+        disposal_volume: float or int
+            Extra volume aspirated and returned to the source. (in uL)
+
+        Returns
+        -------
+        None
+
+        """
+        done = 0
+        while done < len(amounts) and self.journal.replay(self, substance_name, pipette):
+            done += 1
+        amounts, positions_to = amounts[done:], positions_to[done:]
+        if not amounts:
+            return
+        total = sum(amounts)
+        with self.trace.span(
+            "distribute_substance",
+            pipette=pipette.mount,
+            substance=substance_name,
+            destinations=[str(position_to) for position_to in positions_to],
+            volume=float(total),
+        ) as span:
+            self.fresh_tip(pipette)
+            # Find a deck location with enough substance for the whole trip
+            source = self.find_source(
+                substance_name, total + disposal_volume, near=positions_to[0]
+            )
+            substance_position = self.substances.positions[source]
+            span["source"] = f"{self.substances.slot[source]}:{self.substances.well[source]}"
+
+            # Perform swelling
+            self.prepare_tip(pipette, substance_name, substance_position)
+
+            aspirate_loc = self.substances.aspirate_location(source, total + disposal_volume)
+            pipette.aspirate(total + disposal_volume, aspirate_loc)
+            self.clock.move(aspirate_loc)
+            self.clock.wait((total + disposal_volume) / pipette.flow_rate.aspirate)
+            air_gap = distribution_air_gap(pipette, substance_name)
+            if air_gap:
+                pipette.air_gap(air_gap)
+                self.clock.wait(air_gap / pipette.flow_rate.aspirate)
+            for dispensed, (amount, position_to) in enumerate(zip(amounts, positions_to), 1):
+                # The air gap leaves the tip ahead of the liquid
+                pipette.dispense(amount + air_gap, location=position_to.top(z=2))
+                self.clock.move(position_to)
+                self.clock.wait((amount + air_gap) / pipette.flow_rate.dispense)
+                # and is drawn again while liquid is left in the tip
+                if air_gap and (dispensed < len(amounts) or disposal_volume):
+                    pipette.air_gap(air_gap)
+                    self.clock.wait(air_gap / pipette.flow_rate.aspirate)
+                self.substances.draw(source, amount)
+                self.journal.record_transfer(
+                    substance_name,
+                    self.substances.slot[source],
+                    self.substances.well[source],
+                    amount,
+                )
+            pipette.blow_out(substance_position.top())
+            self.clock.move(substance_position)
+            self.clock.wait(command_time["blow_out"])
+            pipette.tip_state.wet(substance_name, self.clock.now)
+
+
+def validate_move(record, line):
+    """
+    Checks a move record against `move_schema`.
+
+    Parameters
+    ----------
+    record : dict
+        Move record read from a plan file.
+    line : int
+        Line of the record in the plan file, for error messages.
+
+    Returns
+    -------
+    dict
+        The record, with the plate as a string and the location as a list.
+
+    Raises
+    ------
+    ValueError
+        If a field is missing or has the wrong type.
+
+    """
+    for key, types in move_schema.items():
+        if key == "substance" and "from_plate" in record:
+            continue
+        if key not in record:
+            raise ValueError(f"Line {line}: move is missing {key!r}.")
+        if not isinstance(record[key], types):
+            raise ValueError(
+                f"Line {line}: {key!r} is {record[key]!r}, "
+                f"expected {' or '.join(t.__name__ for t in types)}."
+            )
+    record["plate"] = str(record["plate"])
+    if isinstance(record["location"], str):
+        record["location"] = [record["location"]]
+    return record
+
+
+def expand_locations(locations, labware):
+    """
+    Expands compact well selectors into the names of wells on a labware, lazily.
+
+    Notes
+    -----
+    Each location is one of:
+
+    - a single well, "A1"
+    - a block of wells between two corners, "A1:E8", taken row by row
+    - a whole row or column, "row:A" or "col:3"
+
+    and may end with a stride, as in "A1:F8:2", to take every second well of
+    the selection. A block runs from its top left to its bottom right corner.
+    Every well is checked against the wells of the labware.
+
+    Parameters
+    ----------
+    locations : list of str
+        Well selectors, in order.
+    labware : labware
+        The labware the wells belong to.
+
+    Yields
+    ------
+    str
+        Well names, in order.
+
+    Raises
+    ------
+    ValueError
+        If a selector names a well that is not on the labware, selects no
+        wells, as a block given from its bottom right corner does, or has a
+        stride below 1.
+
+    """
+    wells = labware.wells_by_name()
+    row_names = list(labware.rows_by_name())
+    column_names = list(labware.columns_by_name())
+    for spec in locations:
+        parts = spec.split(":")
+        stride = 1
+        if len(parts) == 3:
+            stride = parts.pop()
+            if not stride.isdigit() or int(stride) < 1:
+                raise ValueError(
+                    f"Location {spec!r} has a stride of {stride!r}, expected a whole "
+                    f"number of 1 or more."
+                )
+            stride = int(stride)
+        try:
+            if parts[0] == "row":
+                rows, columns = [parts[1]], column_names
+            elif parts[0] == "col":
+                rows, columns = row_names, [parts[1]]
+            else:
+                first_row, first_column = parts[0][:1], parts[0][1:]
+                last_row, last_column = parts[-1][:1], parts[-1][1:]
+                rows = row_names[
+                    row_names.index(first_row):row_names.index(last_row) + 1
+                ]
+                columns = column_names[
+                    column_names.index(first_column):column_names.index(last_column) + 1
+                ]
+        except (IndexError, ValueError):
+            raise ValueError(f"Location {spec!r} does not match the wells of {labware}.")
+        names = [row + column for row in rows for column in columns][::stride]
+        if not names:
+            raise ValueError(
+                f"Location {spec!r} selects no wells of {labware}. A block is given "
+                f"from its top left to its bottom right corner."
+            )
+        for name in names:
+            if name not in wells:
+                raise ValueError(f"Well {name} of {spec!r} is not on {labware}.")
+            yield name
+
+
+def iter_moves(commands, ot):
+    """
+    Expands move commands into one move per destination well, lazily.
+
+    Notes
+    -----
+    Locations may use the compact selectors of `expand_locations`. A command
+    with "from_plate" in place of "substance" moves into each well whatever
+    substance sits in the same-named well of that plate.
+
+    Parameters
+    ----------
+    commands : iterable of dict
+        Move commands, each with a list of locations.
+    ot : Opentrons
+        The Opentrons object holding the deck and substance information.
+
+    Yields
+    ------
+    dict
+        One move per destination well.
+
+    Raises
+    ------
+    ValueError
+        Naming the command, if one of its locations is not a valid selector.
+
+    """
+    for substance in commands:
+        plate = ot.labware[int(substance["plate"])]
+        # A command selects at most a plate of wells, so it is expanded at once
+        try:
+            locations = list(expand_locations(substance["location"], plate))
+        except ValueError as error:
+            raise ValueError(f"Move command {substance}: {error}") from None
+        for location in locations:
+            move = {key: substance.get(key) for key in move_schema}
+            move["location"] = location
+            if "from_plate" in substance:
+                move["substance"] = ot.substances.substance_at(
+                    int(substance["from_plate"]), location
+                )
+            yield move
+
+
+def read_move_commands(path):
+    """
+    Reads move commands from a JSON Lines or CSV plan file, one record at a time.
+
+    Notes
+    -----
+    A JSON Lines file has one move command per line, in the format of
+    `move_commands`. A CSV file has a header row naming the `move_schema`
+    fields and one destination well per row. Records are validated as they
+    are read, so an error is raised at the first bad line.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path of the plan file.
+
+    Yields
+    ------
+    dict
+        Validated move commands.
+
+    """
+    path = Path(path)
+    with open(str(path), newline="") as f:
+        if path.suffix == ".csv":
+            for line, record in enumerate(csv.DictReader(f), start=2):
+                # Empty cells are fields left out of the record
+                record = {key: value for key, value in record.items() if value != ""}
+                if "amount" in record:
+                    try:
+                        amount = float(record["amount"])
+                    except ValueError:
+                        raise ValueError(
+                            f"Line {line}: 'amount' is {record['amount']!r}, "
+                            "expected a number."
+                        ) from None
+                    record["amount"] = int(amount) if amount.is_integer() else amount
+                yield validate_move(record, line)
+        else:
+            for line, text in enumerate(f, start=1):
+                if text.strip():
+                    yield validate_move(json.loads(text), line)
+
+
+def check_feasibility(ot, moves, pipettes, refill=False):
+    """
+    Checks the deck holds enough substance and tips for the moves before any motion.
+
+    Notes
+    -----
+    The trips of the moves are drawn from a copy of the source well ledger,
+    as `plan_draws` makes them. A trip must fit in what is left of one well,
+    disposal volume included, so the remainder of a well too small for the
+    next trip is not counted as available. When resuming, tips are only
+    counted for the trips the journal has not recorded. Tip racks are
+    replaced or added first for the pipettes whose racks have too few tips
+    left.
+
+    Parameters
+    ----------
+    ot : Opentrons
+        The Opentrons object holding the deck and substance information.
+    moves : iterable of dict
+        Moves to be made, in order, with the pipette chosen for each.
+    pipettes : list of pipette
+        The pipettes loaded on the deck.
+    refill : bool
+        Whether substances can be refilled during the run. A substance
+        shortfall is then warned about instead of raised.
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    RuntimeError
+        Listing every substance and tip shortfall found.
+
+    """
+    demand = defaultdict(lambda: 0)
+    undrawn = defaultdict(lambda: 0)
+    tips_needed = defaultdict(lambda: 0)
+    last_substance = {}
+    headroom = {}
+    first_well = defaultdict(lambda: 0)
+    # Transfers already made by the run being resumed, which use no tips
+    done = len(ot.journal.transfers)
+    for substance, pipette, needed, drawn, transfers in plan_draws(moves):
+        if done >= transfers:
+            done -= transfers
+        else:
+            # A trip cut short is finished with a fresh tip
+            done = 0
+            if substance != last_substance.get(pipette.mount):
+                tips_needed[pipette.mount] += 1
+                last_substance[pipette.mount] = substance
+        demand[substance] += drawn
+        if substance not in ot.substances:
+            continue
+        if substance not in headroom:
+            headroom[substance] = ot.substances.headroom(substance)
+        wells = headroom[substance]
+        start = first_well[substance]
+        fitting = np.flatnonzero(wells[start:] >= needed)
+        if len(fitting) == 0:
+            undrawn[substance] += drawn
+            continue
+        well = start + int(fitting[0])
+        # Drawing in deck order never goes back to an earlier well
+        if ot.substances.policy == "sequential":
+            first_well[substance] = well
+        wells[well] -= drawn
+    # What is left to draw, so a refill mid-run asks for all of it at once
+    for substance, amount in demand.items():
+        if substance in ot.substances:
+            ot.substances.demand[ot.substances.ids[substance]] = amount
+    shortfalls = []
+    for substance, amount in demand.items():
+        if substance not in ot.substances:
+            shortfalls.append(f"{substance}: {amount:.0f} uL needed, none on the deck")
+            continue
+        if not undrawn[substance]:
+            continue
+        available = ot.substances.available(substance)
+        if refill:
+            logger.warning(
+                "%s: %.0f uL needed, %.0f uL available above the volume kept in each "
+                "well. The run will pause for about %.0f uL to be refilled.",
+                substance,
+                amount,
+                available,
+                undrawn[substance],
+            )
+            continue
+        shortfall = (
+            f"{substance}: {amount:.0f} uL needed, {available:.0f} uL available above "
+            f"the volume kept in each well"
+        )
+        if amount <= available:
+            shortfall += (
+                f", but {undrawn[substance]:.0f} uL of it cannot be drawn as the trips "
+                f"do not fit in what is left of each well"
+            )
+        shortfalls.append(shortfall)
+    ot.stock_tips(tips_needed)
+    for pipette in pipettes:
+        tips_available = ot.tips.free(pipette)
+        if tips_needed[pipette.mount] > tips_available:
+            shortfalls.append(
+                f"Tips for the {pipette.mount} pipette: {tips_needed[pipette.mount]} needed, "
+                f"{tips_available} left in the tip racks"
+            )
+    if shortfalls:
+        raise RuntimeError(
+            "Not enough on the deck for this run. Please check the deck and try again.\n"
+            + "\n".join(shortfalls)
+        )
+
+
+def well_point(well):
+    """
+    Deck coordinates (x, y) of the top of a well. (in mm)
+    """
+    point = well.top().point
+    return (point.x, point.y)
+
+
+def path_length(points):
+    """
+    Length of the straight-line path through the points, in order. (in mm)
+    """
+    return sum(
+        hypot(x_to - x_from, y_to - y_from)
+        for (x_from, y_from), (x_to, y_to) in zip(points, points[1:])
+    )
+
+
+def order_points(start, points):
+    """
+    Orders points into a short open path from a start point.
+
+    Notes
+    -----
+    Builds a nearest-neighbour path and improves it with 2-opt until no
+    reversal of a section makes it shorter.
+
+    Parameters
+    ----------
+    start : tuple
+        Deck coordinates the path starts from.
+    points : list of tuple
+        Deck coordinates to visit.
+
+    Returns
+    -------
+    list of int
+        Indices into `points`, in visiting order.
+
+    """
+    remaining = list(range(len(points)))
+    tour = []
+    position = start
+    while remaining:
+        nearest = min(
+            remaining,
+            key=lambda i: hypot(points[i][0] - position[0], points[i][1] - position[1]),
+        )
+        remaining.remove(nearest)
+        tour.append(nearest)
+        position = points[nearest]
+    path = [start] + [points[i] for i in tour]
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(path) - 1):
+            for j in range(i + 1, len(path)):
+                before = hypot(path[i][0] - path[i - 1][0], path[i][1] - path[i - 1][1])
+                after = hypot(path[j][0] - path[i - 1][0], path[j][1] - path[i - 1][1])
+                if j + 1 < len(path):
+                    before += hypot(path[j + 1][0] - path[j][0], path[j + 1][1] - path[j][1])
+                    after += hypot(path[j + 1][0] - path[i][0], path[j + 1][1] - path[i][1])
+                if after < before - 1e-9:
+                    path[i:j + 1] = path[i:j + 1][::-1]
+                    tour[i - 1:j] = tour[i - 1:j][::-1]
+                    improved = True
+    return tour
+
+
+def trip_points(ot, substance, pipette, moves):
+    """
+    Deck points visited by a run of moves of one substance with one pipette.
+
+    Notes
+    -----
+    Each trip goes from the source well to its destination, and in distribute
+    mode on through the destinations of the trip and back to the source to
+    blow out. The first well of the substance stands in for the source, so
+    the path is the same however far the run has drawn the wells down.
+
+    Parameters
+    ----------
+    ot : Opentrons
+        The Opentrons object holding the deck and substance information.
+    substance : str
+        Name of the substance moved.
+    pipette : pipette
+        The pipette moving it.
+    moves : list of dict
+        Moves of the run, in order.
+
+    Returns
+    -------
+    list of tuple
+        Deck coordinates (x, y) of each aspiration and dispense, in order.
+
+    """
+    points = [
+        well_point(ot.labware[int(move["plate"])].wells(move["location"])[0])
+        for move in moves
+    ]
+    source = points[0]
+    if substance in ot.substances:
+        source = well_point(ot.substances.positions[ot.substances.first(substance)])
+    path = []
+    if pipette.options["distribute"]:
+        targets = [(point, None, move["amount"]) for point, move in zip(points, moves)]
+        for trip in distribution_trips(targets, pipette, substance):
+            path += [source] + [point for point, _, _ in trip] + [source]
+        return path
+    for point, move in zip(points, moves):
+        chunks = plan_chunks(
+            move["amount"], pipette, air_gap=pipette.options["air_gap"]
+        )
+        path += [source, point] * len(chunks)
+    return path
+
+
+def order_window(ot, moves, state):
+    """
+    Reorders a window of moves to shorten the gantry path.
+
+    Notes
+    -----
+    The moves are cut into runs of one substance and pipette, which share a
+    tip. The destinations of a run are put in a short path from its source,
+    and the runs are then taken one at a time, the one the gantry reaches
+    soonest first. A tip change costs the trip through the trash and tip
+    rack. A run waits for the earlier runs into any of its wells, so each
+    well gets its moves, and so its steps, in the order given. The new order
+    is kept only when its path is shorter.
+
+    Parameters
+    ----------
+    ot : Opentrons
+        The Opentrons object holding the deck and substance information.
+    moves : list of dict
+        Moves to be made, in order, with the pipette chosen for each.
+    state : dict
+        Gantry position ("position") and substance on the tip of each
+        pipette mount ("tips") before the window, updated to after it.
+
+    Returns
+    -------
+    list of dict
+        The reordered moves.
+    float
+        Length of the path of the original order. (in mm)
+    float
+        Length of the path of the new order. (in mm)
+
+    """
+    trash = well_point(ot.protocol.fixed_trash["A1"])
+    given = []
+    runs = []
+    for (substance, pipette), run_moves in groupby(
+        moves, key=lambda move: (move["substance"], move["pipette"])
+    ):
+        run_moves = list(run_moves)
+        path = trip_points(ot, substance, pipette, run_moves)
+        given.append((substance, pipette, run_moves, path))
+        points = [
+            well_point(ot.labware[int(move["plate"])].wells(move["location"])[0])
+            for move in run_moves
+        ]
+        tour = [run_moves[i] for i in order_points(path[0], points)]
+        tour_path = trip_points(ot, substance, pipette, tour)
+        if path_length(tour_path) < path_length(path) - 1e-9:
+            run_moves, path = tour, tour_path
+        runs.append((substance, pipette, run_moves, path))
+
+    def entry(position, tips, substance, pipette, point):
+        """
+        Length of the path to the start of a run, through a tip change.
+        """
+        points = [] if position is None else [position]
+        if tips.get(pipette.mount) != substance:
+            points += [trash, well_point(pipette.tip_racks[0].wells()[0])]
+        return path_length(points + [point])
+
+    def walk(order):
+        """
+        Length of the path through runs in order, and where it leaves the gantry.
+        """
+        position, tips = state["position"], dict(state["tips"])
+        length = 0.0
+        for substance, pipette, _, path in order:
+            length += entry(position, tips, substance, pipette, path[0])
+            length += path_length(path)
+            position = path[-1]
+            tips[pipette.mount] = substance
+        return length, position, tips
+
+    # A run waits for the last earlier run into each of its wells
+    waits_for = []
+    last_run = {}
+    for i, (_, _, run_moves, _) in enumerate(runs):
+        wells = {(str(move["plate"]), move["location"]) for move in run_moves}
+        waits_for.append({last_run[well] for well in wells if well in last_run})
+        for well in wells:
+            last_run[well] = i
+    order = []
+    done = set()
+    position, tips = state["position"], dict(state["tips"])
+    while len(order) < len(runs):
+        ready = [i for i in range(len(runs)) if i not in done and waits_for[i] <= done]
+        chosen = min(
+            ready,
+            key=lambda i: (entry(position, tips, runs[i][0], runs[i][1], runs[i][3][0]), i),
+        )
+        substance, pipette, _, path = runs[chosen]
+        position = path[-1]
+        tips[pipette.mount] = substance
+        done.add(chosen)
+        order.append(runs[chosen])
+    before, position, tips = walk(given)
+    after, new_position, new_tips = walk(order)
+    if after >= before:
+        state.update(position=position, tips=tips)
+        return moves, before, before
+    state.update(position=new_position, tips=new_tips)
+    return [move for _, _, run_moves, _ in order for move in run_moves], before, after
+
+
+def order_moves(ot, moves, window=96, travel=None):
+    """
+    Reorders the moves to shorten gantry travel, a window at a time, lazily.
+
+    Notes
+    -----
+    See `order_window`. Only `window` moves are held at once, so long plans
+    are still read as they are made, and the time taken grows with the
+    length of the plan rather than its square.
+
+    Parameters
+    ----------
+    ot : Opentrons
+        The Opentrons object holding the deck and substance information.
+    moves : iterable of dict
+        Moves to be made, in order, with the pipette chosen for each.
+    window : int
+        Number of moves reordered together.
+    travel : numpy.ndarray, optional
+        Length of the gantry path of the original and the new order, added
+        to as the moves are read. (in mm)
+
+    Yields
+    ------
+    dict
+        The reordered moves.
+
+    """
+    state = {"position": None, "tips": {}}
+    pending = []
+    for move in moves:
+        pending.append(move)
+        if len(pending) < window:
+            continue
+        ordered, before, after = order_window(ot, pending, state)
+        if travel is not None:
+            travel += (before, after)
+        yield from ordered
+        pending = []
+    if pending:
+        ordered, before, after = order_window(ot, pending, state)
+        if travel is not None:
+            travel += (before, after)
+        yield from ordered
+
+
+def pipette_capacity(pipette, air_gap=0):
+    """
+    Largest volume of liquid the pipette can carry in one trip.
+
+    Parameters
+    ----------
+    pipette: pipette
+        The pipette to be used.
+    air_gap: float or int
+        Air gap drawn in after the liquid. (in uL)
+
+    Returns
+    -------
+    float or int
+        The smaller of the pipette and tip capacities, less the air gap. (in uL)
+
+    """
+    capacity = pipette.max_volume
+    if pipette.tip_racks:
+        capacity = min(capacity, pipette.tip_racks[0].wells()[0].max_volume)
+    return capacity - air_gap
+
+
+def select_pipette(amount, pipettes, air_gap=0):
+    """
+    Picks the pipette that moves an amount in the fewest trips.
+
+    Notes
+    -----
+    Pipettes that would have to move less than their minimum volume in a trip
+    are only used when no other pipette can. Ties go to the smaller pipette,
+    which is the more accurate one.
+
+    Parameters
+    ----------
+    amount : float or int
+        Amount of substance to be moved. (in uL)
+    pipettes : list of pipette
+        The pipettes loaded on the deck.
+    air_gap: float or int
+        Air gap drawn in after each aspiration. (in uL)
+
+    Returns
+    -------
+    pipette
+        The pipette to be used.
+
+    """
+    best = None
+    for pipette in pipettes:
+        chunks = plan_chunks(amount, pipette, air_gap)
+        inaccurate = bool(chunks) and min(chunks) < pipette.min_volume
+        key = (inaccurate, len(chunks), pipette.max_volume)
+        if best is None or key < best[0]:
+            best = (key, pipette)
+    return best[1]
+
+
+def merge_moves(moves):
+    """
+    Merges consecutive moves of a substance into the same well, lazily.
+
+    Parameters
+    ----------
+    moves : iterable of dict
+        Moves to be made, in order, with the pipette chosen for each.
+
+    Yields
+    ------
+    dict
+        Moves with the amounts of the moves merged into them added up, and the
+        separate amounts listed in "merged".
+
+    """
+    merged = None
+    for move in moves:
+        key = (
+            move["substance"],
+            str(move["plate"]),
+            move["location"],
+            move["pipette"],
+            move.get("step"),
+        )
+        if merged is not None and key == merged_key:
+            merged["amount"] += move["amount"]
+            merged["merged"].append(move["amount"])
+            continue
+        if merged is not None:
+            yield merged
+        merged = dict(move, merged=[move["amount"]])
+        merged_key = key
+    if merged is not None:
+        yield merged
+
+
+def change_tip(pipette, substance, added_substances):
+    """
+    Asks for a fresh tip unless the pipette's tip last handled the same substance.
+
+    Parameters
+    ----------
+    pipette: pipette
+        The pipette to be used.
+    substance : str
+        Name of the substance to be moved.
+    added_substances : dict
+        Substances handled so far, in order, keyed by pipette mount.
+
+    Returns
+    -------
+    None
+
+    """
+    used = added_substances[pipette.mount]
+    # Check if substance matches the last substance added
+    if len(used) == 0 or substance != used[-1]:
+        # Get a new tip before the next motion
+        pipette.tip_pending = True
+        used.append(substance)
+
+
+def plan_chunks(amount, pipette, air_gap=0):
+    """
+    Splits an amount into the fewest, evenly sized pipette trips.
+
+    Parameters
+    ----------
+    amount : float or int
+        Amount of substance to be moved. (in uL)
+    pipette: pipette
+        The pipette to be used.
+    air_gap: float or int
+        Air gap drawn in after each aspiration. (in uL)
+
+    Returns
+    -------
+    list of float or int
+        Volume of each trip. Empty if there is nothing to move.
+
+    """
+    if amount <= 0:
+        return []
+    capacity = pipette_capacity(pipette, air_gap)
+    num_chunks = int(-(-amount // capacity))
+    if isinstance(amount, int):
+        base, extra = divmod(amount, num_chunks)
+        return [base + 1] * extra + [base] * (num_chunks - extra)
+    return [amount / num_chunks] * num_chunks
+
+
+def plan_draws(moves):
+    """
+    Volumes the trips of the moves draw from the source wells, lazily.
+
+    Notes
+    -----
+    The moves are split into trips as `run` splits them. Each trip aspirates
+    from a single well, and in distribute mode aspirates its disposal volume
+    as well, which goes back into the well.
+
+    Parameters
+    ----------
+    moves : iterable of dict
+        Moves to be made, in order, with the pipette chosen for each.
+
+    Yields
+    ------
+    tuple of str, pipette, float or int, float or int and int
+        Substance and pipette of each trip, the volume its well must hold
+        above its reserve, the volume it takes out of the well (in uL) and
+        the number of transfers the journal records for it.
+
+    """
+    for (substance, pipette), substance_moves in groupby(
+        moves, key=lambda move: (move["substance"], move["pipette"])
+    ):
+        if pipette.options["distribute"]:
+            disposal_volume = pipette.options["disposal_volume"]
+            targets = [(None, None, move["amount"]) for move in substance_moves]
+            for trip in distribution_trips(targets, pipette, substance):
+                total = sum(amount for _, _, amount in trip)
+                yield substance, pipette, total + disposal_volume, total, len(trip)
+            continue
+        for move in substance_moves:
+            for chunk in plan_chunks(
+                move["amount"], pipette, air_gap=pipette.options["air_gap"]
+            ):
+                yield substance, pipette, chunk, chunk, 1
+
+
+def plan_distribution(targets, capacity, min_volume=0):
+    """
+    Splits the well targets into pipette trips for distribute mode.
+
+    Parameters
+    ----------
+    targets : list of tuple
+        ``(location, well, amount)`` for each destination, in dispensing order.
+    capacity : float or int
+        Largest volume that can be dispensed from one aspiration. (in uL)
+    min_volume : float or int
+        Smallest volume the pipette dispenses accurately. (in uL)
+
+    Returns
+    -------
+    list of list of tuple
+        ``(location, well, amount)`` dispensed on each trip. A well is split
+        across consecutive trips when it needs more than what is left in the
+        tip, but never into a part below `min_volume`; the trip ends early
+        instead.
+
+    """
+    trips = []
+    trip = []
+    space = capacity
+    for location, well, amount in targets:
+        while amount > 0:
+            part = min(amount, space)
+            if part < amount:
+                # Leave the next trip at least the minimum volume
+                part = min(part, amount - min_volume)
+            if trip and part < min(amount, min_volume):
+                trips.append(trip)
+                trip = []
+                space = capacity
+                continue
+            trip.append((location, well, part))
+            amount -= part
+            space -= part
+            if space == 0:
+                trips.append(trip)
+                trip = []
+                space = capacity
+    if trip:
+        trips.append(trip)
+    return trips
+
+
+def distribution_air_gap(pipette, substance):
+    """
+    Air gap drawn in after the aspiration and each dispense of a distribute trip. (in uL)
+
+    Notes
+    -----
+    As for single transfers, trimmed handling keeps the air gap for volatile
+    substances only.
+    """
+    if run_options["optimise_handling"] and substance not in run_options["volatile"]:
+        return 0
+    return pipette.options["air_gap"]
+
+
+def distribution_trips(targets, pipette, substance):
+    """
+    Splits the well targets of a substance into distribute trips of a pipette.
+
+    Notes
+    -----
+    A trip carries its disposal volume and air gap besides what it
+    dispenses, and no well is given a part below the pipette's minimum volume.
+
+    Parameters
+    ----------
+    targets : list of tuple
+        ``(location, well, amount)`` for each destination, in dispensing order.
+    pipette : pipette
+        The pipette to be used.
+    substance : str
+        Name of the substance to be moved.
+
+    Returns
+    -------
+    list of list of tuple
+        ``(location, well, amount)`` dispensed on each trip.
+
+    """
+    capacity = (
+        pipette_capacity(pipette, distribution_air_gap(pipette, substance))
+        - pipette.options["disposal_volume"]
+    )
+    return plan_distribution(targets, capacity, pipette.min_volume)
+
+
+def run(protocol: protocol_api.ProtocolContext):
+    """
+    Run the protocol.
+    """
+    setup_logging(run_options["log_level"], run_options["log_path"])
+    ot = None
+    # The log is written out and the journal and database closed however the run ends
+    try:
+        amount_added = defaultdict(lambda: 0)
+        deck_info = substance_locations
+        if run_options["substance_path"]:
+            with open(str(run_options["substance_path"])) as f:
+                deck_info = json.load(f)
+        ot = Opentrons(protocol=protocol, deck_info=deck_info)
+        # The plan is read once for the checks and again as it is executed
+        check_feasibility(ot, plan_moves(ot), ot.pipettes, refill=run_options["refill"])
+        path_travel = np.zeros(2)
+        moves = plan_moves(ot, path_travel)
+        if run_options["optimise_handling"]:
+            moves = merge_moves(moves)
+        added_substances = defaultdict(list)
+        positions_added = defaultdict(str)
+        for (substance, pipette), substance_moves in groupby(
+            moves, key=lambda move: (move["substance"], move["pipette"])
+        ):
+            change_tip(pipette, substance, added_substances)
+            targets = []
+            for move in substance_moves:
+                logger.debug("Move %(substance)s to %(location)s", move)
+                location = move["location"]
+                target_well = ot.labware[int(move["plate"])].wells(location)[0]
+                targets.append((location, target_well, move["amount"]))
+                ot.count_merged(
+                    move,
+                    pipette,
+                    pipette.options["distribute"],
+                    air_gap=pipette.options["air_gap"],
+                    blow_out=pipette.options["blow_out"],
+                )
+                positions_added[location] += substance + " "
+            if pipette.options["distribute"]:
+                disposal_volume = pipette.options["disposal_volume"]
+                for trip in distribution_trips(targets, pipette, substance):
+                    ot.distribute_substance(
+                        amounts=[amount for _, _, amount in trip],
+                        substance_name=substance,
+                        positions_to=[well for _, well, _ in trip],
+                        pipette=pipette,
+                        disposal_volume=disposal_volume,
+                    )
+                    for location, _, amount in trip:
+                        amount_added[location] += amount
+                continue
+            for location, target_well, amount in targets:
+                chunks = plan_chunks(amount, pipette, air_gap=pipette.options["air_gap"])
+                for chunk, amount_to_add in enumerate(chunks):
+                    ot.move_substance(
+                        amount=amount_to_add,
+                        substance_name=substance,
+                        position_to=target_well,
+                        pipette=pipette,
+                        chunk=chunk,
+                        last_chunk=chunk == len(chunks) - 1,
+                    )
+                    amount_added[location] += amount_to_add
+        for line in protocol.commands():
+            continue
+        ot.trace.export(run_options["trace_path"], run_options["trace_log_path"])
+        ot.stock.save(ot.substances)
+        empty_racks = ot.tips.empty(ot.pipettes)
+        if empty_racks:
+            protocol.comment(
+                f"Replace the empty tip racks on slot{'s' * (len(empty_racks) > 1)} "
+                f"{', '.join(map(str, empty_racks))} with full ones before the next run."
+            )
+        if ot.swells_skipped:
+            logger.info(
+                "Skipped %d tip swells, about %.0f s saved.",
+                ot.swells_skipped,
+                ot.swell_time_saved,
+            )
+        if run_options["source_policy"] != "sequential":
+            source_travel, sequential_travel = ot.substances.travel
+            logger.info(
+                "Source to destination travel %.0f mm, against %.0f mm drawing the "
+                "wells in deck order.",
+                source_travel,
+                sequential_travel,
+            )
+        if ot.commands_saved:
+            logger.info(
+                "Trimmed liquid handling dropped %d commands, about %.0f s saved.",
+                ot.commands_saved,
+                ot.handling_time_saved,
+            )
+        if run_options["optimise_path"]:
+            logger.info(
+                "Estimated gantry travel %.0f mm -> %.0f mm, %.0f mm saved.",
+                path_travel[0],
+                path_travel[1],
+                path_travel[0] - path_travel[1],
+            )
+        logger.info(
+            "Amounts added\n%(table)s",
+            {
+                "table": summary_table(amount_added, positions_added),
+                "amount_added": dict(amount_added),
+                "positions_added": dict(positions_added),
+            },
+        )
+    finally:
+        if ot is not None:
+            ot.journal.close()
+            ot.stock.close()
+        close_logs()
@@ -0,0 +1,420 @@
+"""
+Offline run time estimate for the Opentrons protocol scripts.
+
+The protocol data (`substance_locations`, `move_commands` and `run_options`)
+is read from a script without importing it, and the script's own planning
+functions lay out the moves against the stand-in `opentrons` package of the
+simulator, so no robot, network or Opentrons installation is needed. The
+plan is walked the same way `run()` executes it and every step is timed with
+the pipette flow rates and a simple gantry model of the OT-2 deck.
+
+Usage
+-----
+    python opentron_estimate.py opentron_script_MS_topup-uptoF5.py
+"""
+import ast
+import csv
+import json
+import sys
+from pathlib import Path
+from collections import defaultdict
+from functools import lru_cache
+from itertools import groupby
+from math import hypot
+
+# Maximum volume and default flow rates of the GEN2 single channel pipettes
+# (in uL and uL/s)
+PIPETTES = {
+    "p20_single_gen2": {
+        "min_volume": 1, "max_volume": 20, "aspirate": 7.56, "dispense": 7.56
+    },
+    "p300_single_gen2": {
+        "min_volume": 20, "max_volume": 300, "aspirate": 92.86, "dispense": 92.86
+    },
+    "p1000_single_gen2": {
+        "min_volume": 100, "max_volume": 1000, "aspirate": 274.7, "dispense": 274.7
+    },
+}
+
+# Rows, columns and well spacing of the labware used by the scripts (in mm)
+LABWARE = {
+    "fisher_6_wellplate_25000ul": (2, 3, 39.1),
+    "aglient_54_wellplate_2000ul": (6, 9, 13.0),
+    "analyticalsales_48_wellplate_2000ul": (6, 8, 13.1),
+    "opentrons_96_tiprack_20ul": (8, 12, 9.0),
+    "opentrons_96_tiprack_300ul": (8, 12, 9.0),
+    "opentrons_96_tiprack_1000ul": (8, 12, 9.0),
+    "nest_96_wellplate_2ml_deep": (8, 12, 9.0),
+    "corning_96_wellplate_360ul_flat": (8, 12, 9.0),
+    "corning_384_wellplate_112ul_flat": (16, 24, 4.5),
+    "opentrons_1_trash_1100ml_fixed": (1, 1, 0.0),
+}
+DEFAULT_LABWARE = (8, 12, 9.0)
+
+# Deck slots the scripts load their fixed labware into
+TIP_RACK_SLOT = 2
+SECOND_TIP_RACK_SLOT = 1
+PLATE_SLOT = 4
+PLATE_TYPE = "aglient_54_wellplate_2000ul"
+TRASH_SLOT = 12
+
+# Gantry model (in mm/s, mm and s)
+GANTRY_SPEED = 400
+Z_SPEED = 125
+# Height the gantry lifts to between labware and between wells of one labware
+LABWARE_LIFT = 60
+WELL_LIFT = 10
+TIP_PICK_UP_TIME = 3.0
+TIP_DROP_TIME = 2.5
+BLOW_OUT_TIME = 1.0
+
+PHASES = (
+    "travel",
+    "tips",
+    "swell",
+    "aspirate",
+    "dispense",
+    "air_gap",
+    "blow_out",
+)
+
+
+def load_protocol_data(path):
+    """
+    Reads the literal plan data from a protocol script without running it.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path of the protocol script.
+
+    Returns
+    -------
+    dict
+        Module level literal assignments, keyed by name.
+
+    """
+    with open(path) as f:
+        tree = ast.parse(f.read(), filename=str(path))
+    data = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1:
+            target = node.targets[0]
+            if isinstance(target, ast.Name):
+                try:
+                    data[target.id] = ast.literal_eval(node.value)
+                except ValueError:
+                    continue
+    return data
+
+
+def read_move_commands(path):
+    """
+    Reads move commands from a JSON Lines or CSV plan file, as the scripts do.
+    """
+    path = Path(path)
+    with open(str(path), newline="") as f:
+        if path.suffix == ".csv":
+            for line, record in enumerate(csv.DictReader(f), start=2):
+                # Empty cells are fields left out of the record
+                record = {key: value for key, value in record.items() if value != ""}
+                try:
+                    amount = float(record["amount"])
+                except (KeyError, ValueError):
+                    raise ValueError(
+                        f"Line {line}: 'amount' is {record.get('amount')!r}, "
+                        "expected a number."
+                    ) from None
+                record["amount"] = int(amount) if amount.is_integer() else amount
+                record["location"] = [record["location"]]
+                yield record
+        else:
+            for text in f:
+                if text.strip():
+                    record = json.loads(text)
+                    if isinstance(record["location"], str):
+                        record["location"] = [record["location"]]
+                    yield record
+
+
+def expand_locations(locations, labware_type):
+    """
+    Expands compact well selectors over the labware grid, as the scripts do.
+    """
+    rows, columns, _ = LABWARE.get(labware_type, DEFAULT_LABWARE)
+    row_names = [chr(ord("A") + row) for row in range(rows)]
+    column_names = [str(column + 1) for column in range(columns)]
+    for spec in locations:
+        parts = spec.split(":")
+        stride = 1
+        if len(parts) == 3:
+            stride = parts.pop()
+            if not stride.isdigit() or int(stride) < 1:
+                raise ValueError(
+                    f"Location {spec!r} has a stride of {stride!r}, expected a whole "
+                    f"number of 1 or more."
+                )
+            stride = int(stride)
+        if parts[0] == "row":
+            selected_rows, selected_columns = [parts[1]], column_names
+        elif parts[0] == "col":
+            selected_rows, selected_columns = row_names, [parts[1]]
+        else:
+            selected_rows = row_names[
+                row_names.index(parts[0][:1]):row_names.index(parts[-1][:1]) + 1
+            ]
+            selected_columns = column_names[
+                column_names.index(parts[0][1:]):column_names.index(parts[-1][1:]) + 1
+            ]
+        names = [row + column for row in selected_rows for column in selected_columns]
+        if not names[::stride]:
+            raise ValueError(
+                f"Location {spec!r} selects no wells. A block is given from its top "
+                f"left to its bottom right corner."
+            )
+        yield from names[::stride]
+
+
+def slot_center(slot):
+    """
+    Approximate deck coordinates (x, y) of the centre of a deck slot. (in mm)
+    """
+    slot = int(slot)
+    return ((slot - 1) % 3) * 132.5 + 63.88, ((slot - 1) // 3) * 90.5 + 42.74
+
+
+def deck_point(slot, well, labware_type=None):
+    """
+    Approximate deck coordinates (x, y) of a well. (in mm)
+    """
+    x, y = slot_center(slot)
+    rows, columns, spacing = LABWARE.get(labware_type, DEFAULT_LABWARE)
+    row = ord(well[0]) - ord("A")
+    column = int(well[1:]) - 1
+    return (
+        x + (column - (columns - 1) / 2) * spacing,
+        y - (row - (rows - 1) / 2) * spacing,
+    )
+
+
+@lru_cache(maxsize=None)
+def load_planner(path):
+    """
+    Imports a protocol script for its planning functions, once per process.
+    """
+    # The simulator builds its stand-in labware from the tables above
+    from opentron_simulator import load_protocol
+
+    return load_protocol(path)
+
+
+class _Clock:
+    """
+    Accumulates the estimated time of each phase while walking a plan.
+    """
+
+    def __init__(self, start):
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.position = start
+        self.slot = None
+
+    def travel(self, point, slot):
+        x, y = self.position
+        lift = WELL_LIFT if slot == self.slot else LABWARE_LIFT
+        self.phases["travel"] += hypot(point[0] - x, point[1] - y) / GANTRY_SPEED
+        self.phases["travel"] += 2 * lift / Z_SPEED
+        self.position = point
+        self.slot = slot
+
+
+def estimate_plan(script, substance_locations, move_commands, run_options):
+    """
+    Estimates how long a plan takes on the robot.
+
+    Notes
+    -----
+    The plan is laid out by the script itself, against the recording
+    simulator: its `plan_moves` orders the moves and picks their pipettes,
+    its `plan_chunks` and `distribution_trips` split them into trips and its
+    source ledger picks the wells they draw from, so the estimate follows
+    the tip sizes, source policy, liquid height tracking, path ordering and
+    trimmed handling the run uses. Only the timing is modelled here.
+
+    Parameters
+    ----------
+    script : str or Path
+        Path of the protocol script that runs the plan.
+    substance_locations : dict
+        Deck information, as in the protocol scripts.
+    move_commands : list of dict
+        Move commands, as in the protocol scripts.
+    run_options : dict
+        The whole of the run options, as in the protocol scripts.
+
+    Returns
+    -------
+    dict
+        Estimated time of each phase and the `total`. (in s)
+
+    """
+    from opentron_simulator import RecordingContext
+
+    module = load_planner(str(script))
+    module.substance_locations = substance_locations
+    module.move_commands = move_commands
+    # The plan is given here rather than read from the files
+    module.run_options = dict(run_options, substance_path=None, move_path=None)
+    ot = module.Opentrons(protocol=RecordingContext(), deck_info=substance_locations)
+    optimise = module.run_options.get("optimise_handling", False)
+    volatile = module.run_options.get("volatile", [])
+
+    clock = _Clock(deck_point(ot.pipettes[0].tip_rack_slots[0], "A1"))
+    trash = deck_point(TRASH_SLOT, "A1")
+    tips_used = defaultdict(lambda: 0)
+    last_substance = {}
+    # Time each substance last wetted the tip on each pipette
+    wetted = defaultdict(dict)
+
+    def now():
+        return sum(clock.phases.values())
+
+    def change_tip(pipette, substance):
+        if last_substance.get(pipette.mount) == substance:
+            return
+        if tips_used[pipette.mount]:
+            clock.travel(trash, TRASH_SLOT)
+            clock.phases["tips"] += TIP_DROP_TIME
+        used = tips_used[pipette.mount]
+        well = "ABCDEFGH"[used % 8] + str(used // 8 + 1)
+        slot = pipette.tip_rack_slots[0]
+        clock.travel(deck_point(slot, well), slot)
+        clock.phases["tips"] += TIP_PICK_UP_TIME
+        tips_used[pipette.mount] += 1
+        last_substance[pipette.mount] = substance
+        wetted[pipette.mount] = {}
+
+    def swell(pipette, options, substance, point, slot):
+        rule = options["swell_rules"].get(substance, options["swell_default"])
+        wetted_at = wetted[pipette.mount].get(substance)
+        lasts = rule["lasts"]
+        wetted[pipette.mount][substance] = now()
+        if wetted_at is not None and (lasts is None or now() - wetted_at <= lasts):
+            return
+        if not rule["prewet"]:
+            return
+        volume = options["swell_volume"]
+        clock.travel(point, slot)
+        clock.phases["swell"] += volume / pipette.flow_rate.aspirate
+        clock.phases["swell"] += options["swell_delay"]
+        if not optimise:
+            clock.phases["swell"] += 2 * WELL_LIFT / Z_SPEED
+        clock.phases["swell"] += volume / pipette.flow_rate.dispense
+        wetted[pipette.mount][substance] = now()
+
+    def source(substance, amount, well):
+        row = ot.find_source(substance, amount, near=well)
+        return row, tuple(ot.substances.points[row]), int(ot.substances.slot[row])
+
+    def destination(move):
+        plate = int(move["plate"])
+        well = ot.labware[plate].wells(move["location"])[0]
+        return well, module.well_point(well), plate
+
+    moves = module.plan_moves(ot)
+    if optimise:
+        moves = module.merge_moves(moves)
+    for (substance, pipette), substance_moves in groupby(
+        moves, key=lambda move: (move["substance"], move["pipette"])
+    ):
+        change_tip(pipette, substance)
+        options = pipette.options
+        if options.get("distribute", False):
+            disposal_volume = options["disposal_volume"]
+            targets = [
+                (move, destination(move), move["amount"]) for move in substance_moves
+            ]
+            gap = module.distribution_air_gap(pipette, substance)
+            for trip in module.distribution_trips(targets, pipette, substance):
+                total = sum(amount for _, _, amount in trip)
+                row, point, slot = source(substance, total + disposal_volume, trip[0][1][0])
+                swell(pipette, options, substance, point, slot)
+                clock.travel(point, slot)
+                clock.phases["aspirate"] += (
+                    (total + disposal_volume) / pipette.flow_rate.aspirate
+                )
+                if gap:
+                    # Drawn after the aspiration and each dispense but the
+                    # last, and after that too if the disposal volume is left
+                    draws = len(trip) + bool(disposal_volume)
+                    clock.phases["air_gap"] += draws * gap / pipette.flow_rate.aspirate
+                for _, (_, to_point, to_slot), amount in trip:
+                    clock.travel(to_point, to_slot)
+                    clock.phases["dispense"] += (amount + gap) / pipette.flow_rate.dispense
+                clock.travel(point, slot)
+                clock.phases["blow_out"] += BLOW_OUT_TIME
+                ot.substances.draw(row, total)
+            continue
+        air_gap = options.get("air_gap", 0)
+        for move in substance_moves:
+            well, to_point, to_slot = destination(move)
+            chunks = module.plan_chunks(move["amount"], pipette, air_gap=air_gap)
+            for chunk, amount in enumerate(chunks):
+                row, point, slot = source(substance, amount, well)
+                swell(pipette, options, substance, point, slot)
+                clock.travel(point, slot)
+                clock.phases["aspirate"] += amount / pipette.flow_rate.aspirate
+                # Trimmed handling keeps the air gap for volatile substances only
+                gap = air_gap if not optimise or substance in volatile else 0
+                if gap:
+                    clock.phases["air_gap"] += gap / pipette.flow_rate.aspirate
+                    clock.phases["air_gap"] += WELL_LIFT / Z_SPEED
+                clock.travel(to_point, to_slot)
+                clock.phases["dispense"] += (amount + gap) / pipette.flow_rate.dispense
+                # and blows out only after the last trip into the well
+                if options.get("blow_out", False) and (
+                    not optimise or chunk == len(chunks) - 1
+                ):
+                    clock.phases["blow_out"] += BLOW_OUT_TIME
+                ot.substances.draw(row, amount)
+
+    estimate = dict(clock.phases)
+    estimate["total"] = sum(clock.phases.values())
+    return estimate
+
+
+def estimate_protocol(path, **run_options):
+    """
+    Estimates how long a protocol script takes on the robot.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path of the protocol script.
+    **run_options
+        Overrides of the script's `run_options`.
+
+    Returns
+    -------
+    dict
+        Estimated time of each phase and the `total`. (in s)
+
+    """
+    data = load_protocol_data(path)
+    options = dict(data["run_options"])
+    options.update(run_options)
+    if options.get("substance_path"):
+        with open(str(options["substance_path"])) as f:
+            data["substance_locations"] = json.load(f)
+    if options.get("move_path"):
+        data["move_commands"] = list(read_move_commands(options["move_path"]))
+    return estimate_plan(
+        path, data["substance_locations"], data["move_commands"], options
+    )
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        estimate = estimate_protocol(path)
+        print(path)
+        for phase, seconds in estimate.items():
+            print(f"    {phase:<10}{seconds / 60:8.1f} min")
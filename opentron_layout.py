@@ -0,0 +1,309 @@
+"""
+Deck layout optimiser for the Opentrons protocol scripts.
+
+The script is run on the recording simulator and the gantry's trips between
+labware are counted: sources, destination plate, tip racks and the fixed
+trash. Deck slots are then assigned to the labware so that the distance
+between slot centres, weighted by those counts, is as small as possible. The
+deck, the plan and the slot options are rewritten for the new layout, and the
+estimator predicts the run time before and after.
+
+Usage
+-----
+    python opentron_layout.py opentron_script_MS_topup-uptoF5.py \\
+        --deck deck.json --moves moves.jsonl
+"""
+import argparse
+import json
+import tempfile
+from collections import Counter
+from itertools import permutations
+from math import hypot
+from pathlib import Path
+
+from opentron_estimate import (
+    PLATE_SLOT,
+    SECOND_TIP_RACK_SLOT,
+    TIP_RACK_SLOT,
+    TRASH_SLOT,
+    estimate_protocol,
+    load_protocol_data,
+    read_move_commands,
+    slot_center,
+)
+from opentron_simulator import simulate_protocol
+
+# Deck slots labware can be moved between; the trash stays on its own slot
+SLOTS = tuple(range(1, 12))
+# Largest number of layouts tried one by one before switching to swaps
+EXHAUSTIVE_LIMIT = 500000
+
+
+def load_plan(path, **run_options):
+    """
+    Reads the deck, plan and run options of a protocol script.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path of the protocol script.
+    **run_options
+        Overrides of the script's `run_options`.
+
+    Returns
+    -------
+    tuple of dict, list of dict and dict
+        Deck information, move commands and run options.
+
+    """
+    data = load_protocol_data(path)
+    options = dict(data["run_options"])
+    options.update(run_options)
+    substance_locations = data.get("substance_locations", {})
+    move_commands = data.get("move_commands", [])
+    if options.get("substance_path"):
+        with open(str(options["substance_path"])) as f:
+            substance_locations = json.load(f)
+    if options.get("move_path"):
+        move_commands = list(read_move_commands(options["move_path"]))
+    return substance_locations, move_commands, options
+
+
+def visit_counts(command_log):
+    """
+    Counts the gantry trips between each pair of deck slots.
+
+    Parameters
+    ----------
+    command_log : list of dict
+        Structured commands recorded by the simulator.
+
+    Returns
+    -------
+    Counter
+        Number of trips, keyed by the pair of slots in ascending order.
+
+    """
+    visits = Counter()
+    last = None
+    for entry in command_log:
+        slot = entry.get("slot")
+        if slot is None:
+            continue
+        if last is not None and slot != last:
+            visits[tuple(sorted((last, slot)))] += 1
+        last = slot
+    return visits
+
+
+def layout_cost(visits, assignment):
+    """
+    Visit-weighted distance between the slots of a layout. (in mm)
+
+    Parameters
+    ----------
+    visits : dict
+        Number of trips, keyed by pairs of current slots.
+    assignment : dict
+        New slot of each current slot.
+
+    Returns
+    -------
+    float
+        Total distance the gantry travels between labware.
+
+    """
+    cost = 0.0
+    for (first, second), count in visits.items():
+        x_from, y_from = slot_center(assignment.get(first, first))
+        x_to, y_to = slot_center(assignment.get(second, second))
+        cost += count * hypot(x_to - x_from, y_to - y_from)
+    return cost
+
+
+def optimise_layout(visits, labware_slots, slots=SLOTS):
+    """
+    Assigns deck slots to labware to minimise the visit-weighted travel.
+
+    Notes
+    -----
+    Every layout is tried when there are few enough of them. Otherwise the
+    current layout is improved by moving labware to free slots and swapping
+    pairs of labware until no move makes it better. The current layout is
+    kept unless another one is strictly better.
+
+    Parameters
+    ----------
+    visits : dict
+        Number of trips, keyed by pairs of current slots.
+    labware_slots : list of int
+        Current slots of the labware that may be moved.
+    slots : tuple of int
+        Slots the labware may be moved to.
+
+    Returns
+    -------
+    dict
+        New slot of each current slot.
+
+    """
+    labware_slots = sorted(labware_slots)
+    best = {slot: slot for slot in labware_slots}
+    best_cost = layout_cost(visits, best)
+    layouts = 1
+    for count in range(len(slots), len(slots) - len(labware_slots), -1):
+        layouts *= count
+    if layouts <= EXHAUSTIVE_LIMIT:
+        for chosen in permutations(slots, len(labware_slots)):
+            assignment = dict(zip(labware_slots, chosen))
+            cost = layout_cost(visits, assignment)
+            if cost < best_cost - 1e-9:
+                best, best_cost = assignment, cost
+        return best
+    improved = True
+    while improved:
+        improved = False
+        for slot in labware_slots:
+            for target in slots:
+                assignment = dict(best)
+                # Move to a free slot, or swap with the labware already there
+                for other, placed in best.items():
+                    if placed == target:
+                        assignment[other] = best[slot]
+                assignment[slot] = target
+                cost = layout_cost(visits, assignment)
+                if cost < best_cost - 1e-9:
+                    best, best_cost = assignment, cost
+                    improved = True
+    return best
+
+
+def relayout(substance_locations, move_commands, run_options, assignment):
+    """
+    Rewrites the deck, plan and slot options for a new layout.
+
+    Parameters
+    ----------
+    substance_locations : dict
+        Deck information, as in the protocol scripts.
+    move_commands : list of dict
+        Move commands, as in the protocol scripts.
+    run_options : dict
+        Run options, as in the protocol scripts.
+    assignment : dict
+        New slot of each current slot.
+
+    Returns
+    -------
+    tuple of dict, list of dict and dict
+        Deck information, move commands and the run options that change.
+
+    """
+    def moved(slot):
+        return assignment.get(int(slot), int(slot))
+
+    deck = {str(moved(slot)): wells for slot, wells in substance_locations.items()}
+    moves = []
+    for command in move_commands:
+        command = dict(command)
+        command["plate"] = str(moved(command["plate"]))
+        if "from_plate" in command:
+            command["from_plate"] = str(moved(command["from_plate"]))
+        moves.append(command)
+    options = {"plate_slot": moved(run_options.get("plate_slot", PLATE_SLOT))}
+    if isinstance(run_options.get("minimum_volume"), dict):
+        options["minimum_volume"] = {
+            str(moved(slot)): volume
+            for slot, volume in run_options["minimum_volume"].items()
+        }
+    if "steps" in run_options:
+        options["steps"] = {
+            step: dict(step_options, tip_rack_slot=moved(step_options["tip_rack_slot"]))
+            for step, step_options in run_options["steps"].items()
+        }
+    else:
+        options["tip_rack_slot"] = moved(run_options.get("tip_rack_slot", TIP_RACK_SLOT))
+        if run_options.get("multi_pipette"):
+            options["second_tip_rack_slot"] = moved(
+                run_options.get("second_tip_rack_slot", SECOND_TIP_RACK_SLOT)
+            )
+    return deck, moves, options
+
+
+def optimise_protocol(path, deck_path=None, move_path=None, **run_options):
+    """
+    Finds a better deck layout for a protocol script and predicts its run time.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path of the protocol script.
+    deck_path : str or Path, optional
+        Where to write the new deck, for `run_options["substance_path"]`.
+    move_path : str or Path, optional
+        Where to write the new plan as JSON Lines, for `run_options["move_path"]`.
+    **run_options
+        Overrides of the script's `run_options`.
+
+    Returns
+    -------
+    dict
+        The new slot of each labware slot ("assignment"), the new deck,
+        moves and slot options, and the estimated run time before and after.
+        (in s)
+
+    """
+    substance_locations, move_commands, options = load_plan(path, **run_options)
+    context = simulate_protocol(path, **run_options)
+    visits = visit_counts(context.command_log)
+    labware_slots = [slot for slot in context.loaded_labware if slot != TRASH_SLOT]
+    slots = tuple(slot for slot in SLOTS if slot != TRASH_SLOT)
+    assignment = optimise_layout(visits, labware_slots, slots)
+    deck, moves, slot_options = relayout(
+        substance_locations, move_commands, options, assignment
+    )
+    with tempfile.TemporaryDirectory() as folder:
+        deck_path = deck_path or Path(folder) / "deck.json"
+        move_path = move_path or Path(folder) / "moves.jsonl"
+        with open(str(deck_path), "w") as f:
+            json.dump(deck, f, indent=4)
+        with open(str(move_path), "w") as f:
+            for command in moves:
+                f.write(json.dumps(command) + "\n")
+        new_options = dict(run_options, **slot_options)
+        new_options["substance_path"] = str(deck_path)
+        new_options["move_path"] = str(move_path)
+        before = estimate_protocol(path, **run_options)["total"]
+        after = estimate_protocol(path, **new_options)["total"]
+    return {
+        "assignment": {slot: assignment[slot] for slot in sorted(assignment)},
+        "substance_locations": deck,
+        "move_commands": moves,
+        "run_options": slot_options,
+        "travel_before": layout_cost(visits, {}),
+        "travel_after": layout_cost(visits, assignment),
+        "time_before": before,
+        "time_after": after,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("script")
+    parser.add_argument("--deck", help="write the new deck to this JSON file")
+    parser.add_argument("--moves", help="write the new plan to this JSON Lines file")
+    args = parser.parse_args()
+
+    result = optimise_protocol(args.script, args.deck, args.moves)
+    for slot, new_slot in result["assignment"].items():
+        print(f"    slot {slot:>2} -> {new_slot:>2}")
+    print(f"    run_options: {json.dumps(result['run_options'])}")
+    print(
+        f"    travel between labware {result['travel_before'] / 1000:.1f} m -> "
+        f"{result['travel_after'] / 1000:.1f} m"
+    )
+    print(
+        f"    estimated run time {result['time_before'] / 60:.1f} min -> "
+        f"{result['time_after'] / 60:.1f} min, "
+        f"{(result['time_before'] - result['time_after']) / 60:.1f} min saved"
+    )
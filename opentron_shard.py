@@ -0,0 +1,404 @@
+"""
+Splits the plan of a protocol script across several robots.
+
+The moves are grouped into units that must run on one robot: every move
+into a destination plate, or with `--by well` every move into a destination
+well, so the steps into a well keep their order. Plates are handed out
+longest first to the robot with the least estimated run time, and wells in
+runs of about equal estimated time. Each robot
+gets a copy of the script holding its own moves and the source wells they
+draw from, filled with what the robot needs above the volume kept in each
+well, so every protocol is self-contained and passes its own feasibility
+check.
+
+Usage
+-----
+    python opentron_shard.py opentron_script_MS_transfer_and_topup.py \\
+        --robots 3 --out shards --deck deck.json --moves moves.jsonl
+"""
+import argparse
+import ast
+import json
+import re
+from collections import defaultdict
+from functools import lru_cache
+from pathlib import Path
+from pprint import pformat
+
+from opentron_estimate import PLATE_SLOT, PLATE_TYPE, estimate_plan, expand_locations
+from opentron_layout import load_plan
+
+
+def expand_plan(substance_locations, move_commands, plate_slot=PLATE_SLOT):
+    """
+    Expands the move commands into one move per destination well.
+
+    Notes
+    -----
+    Every field of a command, such as its step or `from_plate`, is kept so
+    the moves can be written back out.
+
+    Parameters
+    ----------
+    substance_locations : dict
+        Deck information, as in the protocol scripts.
+    move_commands : list of dict
+        Move commands, as in the protocol scripts.
+    plate_slot : int
+        Deck slot of the destination plate the scripts load.
+
+    Returns
+    -------
+    list of dict
+        Move commands with a single destination well each.
+
+    """
+    moves = []
+    for command in move_commands:
+        plate = int(command["plate"])
+        if plate == plate_slot:
+            plate_type = PLATE_TYPE
+        else:
+            plate_type = substance_locations.get(str(plate), {}).get("type")
+        locations = command["location"]
+        if isinstance(locations, str):
+            locations = [locations]
+        for location in expand_locations(locations, plate_type):
+            moves.append(dict(command, location=[location]))
+    return moves
+
+
+def unit_of(move, by="plate"):
+    """
+    Unit a move belongs to, which must run on one robot.
+
+    Parameters
+    ----------
+    move : dict
+        Move command with a single destination well.
+    by : str
+        "plate" to keep each destination plate on one robot, "well" to keep
+        only each destination well on one robot.
+
+    Returns
+    -------
+    str or tuple of str
+        Plate slot, or plate slot and well name.
+
+    """
+    if by == "plate":
+        return str(move["plate"])
+    if by == "well":
+        return (str(move["plate"]), move["location"][0])
+    raise ValueError(f"Unknown unit {by!r}.")
+
+
+def balance(unit_times, robots, contiguous=False):
+    """
+    Assigns units to robots, longest first to the least loaded robot.
+
+    Notes
+    -----
+    With `contiguous` the units are instead cut into runs of about equal
+    time in plan order, so each robot works on neighbouring wells.
+
+    Parameters
+    ----------
+    unit_times : dict
+        Estimated run time of each unit, in plan order. (in s)
+    robots : int
+        Number of robots.
+    contiguous : bool
+        Whether to give each robot a run of consecutive units.
+
+    Returns
+    -------
+    list of list
+        Units of each robot, in the order they were given.
+
+    """
+    shards = [[] for _ in range(robots)]
+    if contiguous:
+        total = sum(unit_times.values())
+        elapsed = 0.0
+        for unit, seconds in unit_times.items():
+            # The robot whose share of the run covers the middle of the unit
+            robot = min(int((elapsed + seconds / 2) / total * robots), robots - 1)
+            shards[robot].append(unit)
+            elapsed += seconds
+        return shards
+    loads = [0.0] * robots
+    for unit in sorted(unit_times, key=unit_times.get, reverse=True):
+        robot = loads.index(min(loads))
+        shards[robot].append(unit)
+        loads[robot] += unit_times[unit]
+    return shards
+
+
+def source_substance(move, substance_locations):
+    """
+    Source well pinned by a move, and the substance it draws.
+    """
+    if "from_plate" in move:
+        slot = str(move["from_plate"])
+        well_name = move["location"][0]
+        return (slot, well_name), substance_locations[slot][well_name]["substance"]
+    return None, move["substance"]
+
+
+def shard_deck(substance_locations, moves, minimum_volume):
+    """
+    Deck information holding what one robot draws, above the volume kept.
+
+    Notes
+    -----
+    Wells are taken in deck order, as the scripts draw from them, and filled
+    up to their amount in the original deck. Each well is given room for one
+    extra move of its substance, as a move too large for what is left in a
+    well is drawn from the next one.
+
+    Parameters
+    ----------
+    substance_locations : dict
+        Deck information, as in the protocol scripts.
+    moves : list of dict
+        Moves of the robot, with a single destination well each.
+    minimum_volume : float, int or dict
+        Volume that must stay in a source well, or that volume by deck slot.
+        (in uL)
+
+    Returns
+    -------
+    dict
+        Deck information of the robot.
+
+    Raises
+    ------
+    ValueError
+        If the original deck does not hold enough of a substance for the robot.
+
+    """
+    def reserve(slot):
+        if isinstance(minimum_volume, dict):
+            return float(minimum_volume.get(str(slot), 0))
+        return float(minimum_volume)
+
+    demand = defaultdict(lambda: 0)
+    largest = defaultdict(lambda: 0)
+    pinned = {}
+    for move in moves:
+        well, substance = source_substance(move, substance_locations)
+        if well is not None:
+            pinned[well] = pinned.get(well, 0) + move["amount"]
+            continue
+        demand[substance] += move["amount"]
+        largest[substance] = max(largest[substance], move["amount"])
+    plates = {str(move["plate"]) for move in moves}
+    short = {}
+    deck = {}
+    for slot, labware in substance_locations.items():
+        wells = {}
+        for well_name, well in labware.items():
+            if well_name in ("name", "type"):
+                continue
+            substance = well["substance"]
+            if (slot, well_name) in pinned:
+                need = pinned[(slot, well_name)]
+            elif demand[substance] > 0:
+                need = demand[substance] + largest[substance]
+            else:
+                continue
+            fill = min(float(well["amount"]), need + reserve(slot))
+            wells[well_name] = {"substance": substance, "amount": round(fill, 1)}
+            if (slot, well_name) in pinned:
+                short[f"{substance} in {well_name} on slot {slot}"] = need + reserve(slot) - fill
+            else:
+                demand[substance] -= fill - reserve(slot) - largest[substance]
+        if wells or slot in plates:
+            deck[slot] = {"name": labware["name"], "type": labware["type"]}
+            deck[slot].update(wells)
+    short.update(demand)
+    shortfalls = [f"{name}: {amount:.0f} uL" for name, amount in short.items() if amount > 0]
+    if shortfalls:
+        raise ValueError(
+            "The deck does not hold enough for one robot's moves. Short of "
+            + ", ".join(shortfalls)
+        )
+    return deck
+
+
+@lru_cache(maxsize=None)
+def read_template(template):
+    """
+    Lines of a protocol script and the line span of its plan literals.
+
+    Parameters
+    ----------
+    template : str or Path
+        Path of the protocol script.
+
+    Returns
+    -------
+    tuple of tuple of str and dict
+        Lines of the script and the first and last line numbers of the
+        `substance_locations`, `move_commands` and `run_options` literals.
+
+    """
+    with open(str(template)) as f:
+        source = f.read()
+    spans = {
+        node.targets[0].id: (node.lineno, node.end_lineno)
+        for node in ast.parse(source).body
+        if isinstance(node, ast.Assign)
+        and isinstance(node.targets[0], ast.Name)
+        and node.targets[0].id in ("substance_locations", "move_commands", "run_options")
+    }
+    return tuple(source.splitlines(keepends=True)), spans
+
+
+def write_protocol(
+    template, path, substance_locations, move_commands, name, run_options=None
+):
+    """
+    Writes a copy of a protocol script with its own deck and plan.
+
+    Parameters
+    ----------
+    template : str or Path
+        Path of the protocol script to copy.
+    path : str or Path
+        Path of the new script.
+    substance_locations : dict
+        Deck information of the new script.
+    move_commands : list of dict
+        Move commands of the new script.
+    name : str
+        Protocol name of the new script.
+    run_options : dict, optional
+        Overrides of the script's `run_options`, written just after them.
+
+    Returns
+    -------
+    None
+
+    """
+    lines, spans = read_template(str(template))
+    lines = list(lines)
+    # Python literals, as JSON would write true, false and null
+    literals = {
+        "substance_locations": pformat(substance_locations, sort_dicts=False),
+        "move_commands": pformat(move_commands, sort_dicts=False),
+    }
+    # Replace the literals from the bottom up so earlier line numbers hold
+    for literal, (first, last) in sorted(spans.items(), key=lambda span: -span[1][0]):
+        if literal == "run_options":
+            if run_options:
+                text = f"run_options.update({pformat(run_options, sort_dicts=False)})\n"
+                lines[last:last] = [text]
+            continue
+        lines[first - 1:last] = [f"{literal} = {literals[literal]}\n"]
+    source = "".join(lines)
+    source = re.sub(
+        r'("protocolName": )"[^"]*"', lambda match: f"{match.group(1)}{json.dumps(name)}", source, 1
+    )
+    # The plan is in the script itself, not in the files it was read from
+    source = re.sub(r'("(?:substance|move)_path": )[^,\n]+,', r"\1None,", source)
+    with open(str(path), "w") as f:
+        f.write(source)
+
+
+def shard_protocol(path, robots, out_dir, by="plate", **run_options):
+    """
+    Splits the plan of a protocol script into one protocol per robot.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path of the protocol script.
+    robots : int
+        Number of robots.
+    out_dir : str or Path
+        Folder to write the protocols to.
+    by : str
+        Unit kept on one robot, "plate" or "well".
+    **run_options
+        Overrides of the script's `run_options`.
+
+    Returns
+    -------
+    dict
+        Estimated run time on one robot ("single"), path, moves and
+        estimated run time of each robot's protocol ("shards") and the
+        longest of those ("makespan"). (in s)
+
+    """
+    substance_locations, move_commands, options = load_plan(path, **run_options)
+    plate_slot = options.get("plate_slot", PLATE_SLOT)
+    moves = expand_plan(substance_locations, move_commands, plate_slot)
+    units = defaultdict(list)
+    for move in moves:
+        units[unit_of(move, by)].append(move)
+    unit_times = {
+        unit: estimate_plan(path, substance_locations, unit_moves, options)["total"]
+        for unit, unit_moves in units.items()
+    }
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    name = ast.literal_eval(
+        re.search(r'"protocolName": ("[^"]*")', Path(path).read_text()).group(1)
+    )
+    shards = []
+    for robot, assigned in enumerate(balance(unit_times, robots, by == "well"), 1):
+        if not assigned:
+            continue
+        assigned = set(assigned)
+        # Keep the plan order, which the steps into each well depend on
+        robot_moves = [move for move in moves if unit_of(move, by) in assigned]
+        deck = shard_deck(substance_locations, robot_moves, options["minimum_volume"])
+        shard_path = out_dir / f"{Path(path).stem}_robot{robot}.py"
+        write_protocol(
+            path, shard_path, deck, robot_moves, f"{name} (robot {robot} of {robots})"
+        )
+        shards.append(
+            {
+                "robot": robot,
+                "path": str(shard_path),
+                "moves": len(robot_moves),
+                "time": estimate_plan(path, deck, robot_moves, options)["total"],
+            }
+        )
+    single = estimate_plan(path, substance_locations, move_commands, options)["total"]
+    return {
+        "single": single,
+        "shards": shards,
+        "makespan": max(shard["time"] for shard in shards),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("script")
+    parser.add_argument("--robots", type=int, required=True)
+    parser.add_argument("--out", default="shards", help="folder for the protocols")
+    parser.add_argument("--by", choices=("plate", "well"), default="plate")
+    parser.add_argument("--deck", help="read the deck from this JSON file")
+    parser.add_argument("--moves", help="read the plan from this JSON Lines or CSV file")
+    args = parser.parse_args()
+
+    overrides = {}
+    if args.deck:
+        overrides["substance_path"] = args.deck
+    if args.moves:
+        overrides["move_path"] = args.moves
+    result = shard_protocol(args.script, args.robots, args.out, args.by, **overrides)
+    for shard in result["shards"]:
+        print(
+            f"    robot {shard['robot']}: {shard['moves']:>4} moves, "
+            f"{shard['time'] / 60:6.1f} min  {shard['path']}"
+        )
+    if len(result["shards"]) < args.robots:
+        print(f"    only {len(result['shards'])} units to share, some robots are idle")
+    print(
+        f"    run time {result['single'] / 60:.1f} min on one robot -> "
+        f"{result['makespan'] / 60:.1f} min on {args.robots}"
+    )
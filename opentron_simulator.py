@@ -0,0 +1,460 @@
+"""
+Fast in-process simulator for the Opentrons protocol scripts.
+
+A protocol script is loaded with a small stand-in for the `opentrons`
+package and its `run()` is executed against `RecordingContext`, a recording
+`ProtocolContext` that supports what the scripts use: labware, pipettes,
+liquid handling, tips, delays, pauses and comments. Every step is kept as a
+structured command, and the pipette volumes and tips are checked as the robot
+would, so a plan can be checked in milliseconds without the Opentrons
+simulation stack.
+
+Usage
+-----
+    python opentron_simulator.py opentron_script_MS_topup-uptoF5.py
+"""
+import contextlib
+import importlib.util
+import io
+import sys
+import time
+import types
+from collections import Counter, namedtuple
+from pathlib import Path
+
+from opentron_estimate import DEFAULT_LABWARE, LABWARE, PIPETTES, TRASH_SLOT, deck_point
+
+# Well diameter, well depth, labware height and well volume of the labware
+# used by the scripts (in mm and uL)
+WELLS = {
+    "fisher_6_wellplate_25000ul": (35.43, 17.4, 20.27, 25000),
+    "aglient_54_wellplate_2000ul": (10.0, 17.4, 20.02, 2000),
+    "analyticalsales_48_wellplate_2000ul": (11.56, 17.4, 20.02, 2000),
+    "opentrons_96_tiprack_20ul": (3.27, 39.2, 64.69, 20),
+    "opentrons_96_tiprack_300ul": (5.23, 59.3, 64.49, 300),
+    "opentrons_96_tiprack_1000ul": (7.23, 88.0, 97.47, 1000),
+    "nest_96_wellplate_2ml_deep": (8.2, 38.05, 41.0, 2000),
+    "corning_96_wellplate_360ul_flat": (6.86, 10.67, 14.22, 360),
+    "corning_384_wellplate_112ul_flat": (3.63, 11.43, 14.22, 112),
+    "opentrons_1_trash_1100ml_fixed": (None, 0.0, 82.0, 1100000),
+}
+DEFAULT_WELLS = (6.86, 10.67, 14.22, 360)
+
+# Height above the well bottom the pipettes aspirate and dispense at (in mm)
+WELL_BOTTOM_CLEARANCE = 1.0
+
+Point = namedtuple("Point", ["x", "y", "z"])
+
+
+class Location:
+    """
+    A point on the deck and the well it belongs to.
+    """
+
+    def __init__(self, point, labware):
+        self.point = point
+        self.labware = labware
+
+    def __str__(self):
+        return str(self.labware)
+
+
+class Well:
+    """
+    Well of a recorded labware.
+    """
+
+    def __init__(self, labware, name, point, diameter, depth, max_volume):
+        self.parent = labware
+        self.well_name = name
+        self._point = point
+        self.diameter = diameter
+        self.length = None
+        self.width = None
+        self.depth = depth
+        self.max_volume = max_volume
+
+    def top(self, z=0):
+        return Location(self._point._replace(z=self._point.z + z), self)
+
+    def bottom(self, z=0):
+        return Location(self._point._replace(z=self._point.z - self.depth + z), self)
+
+    def __str__(self):
+        return f"{self.well_name} of {self.parent}"
+
+
+class Labware:
+    """
+    Labware loaded into a deck slot of a recorded protocol.
+
+    Notes
+    -----
+    A tip rack may stand for several racks swapped in one after another, in
+    which case `wells()` lists the tips of every rack.
+    """
+
+    def __init__(self, load_name, slot, racks=1):
+        self.load_name = load_name
+        self.slot = slot
+        rows, columns, _ = LABWARE.get(load_name, DEFAULT_LABWARE)
+        diameter, depth, height, max_volume = WELLS.get(load_name, DEFAULT_WELLS)
+        self._rows = {}
+        self._columns = {}
+        for row in range(rows):
+            for column in range(columns):
+                name = f"{chr(ord('A') + row)}{column + 1}"
+                x, y = deck_point(slot, name, load_name)
+                well = Well(self, name, Point(x, y, height), diameter, depth, max_volume)
+                self._rows.setdefault(name[0], []).append(well)
+                self._columns.setdefault(name[1:], []).append(well)
+        # Wells are ordered down each column, as on the robot
+        self._wells = [well for column in self._columns.values() for well in column]
+        self._by_name = {well.well_name: well for well in self._wells}
+        for _ in range(racks - 1):
+            self._wells += [
+                Well(self, well.well_name, well._point, diameter, depth, max_volume)
+                for well in self._wells[:rows * columns]
+            ]
+
+    def wells(self, *names):
+        if names:
+            return [self._by_name[name] for name in names]
+        return list(self._wells)
+
+    def wells_by_name(self):
+        return dict(self._by_name)
+
+    def rows_by_name(self):
+        return dict(self._rows)
+
+    def columns_by_name(self):
+        return dict(self._columns)
+
+    def __getitem__(self, name):
+        return self._by_name[name]
+
+    def __str__(self):
+        return f"{self.load_name} on {self.slot}"
+
+
+class FlowRates:
+    """
+    Flow rates of a recorded pipette. (in uL/s)
+    """
+
+    def __init__(self, aspirate, dispense):
+        self.aspirate = aspirate
+        self.dispense = dispense
+        self.blow_out = dispense
+
+
+class Pipette:
+    """
+    Pipette of a recorded protocol, checking its volume and tip as the robot does.
+    """
+
+    def __init__(self, context, name, mount, tip_racks=None):
+        if name not in PIPETTES:
+            raise ValueError(f"Pipette {name} is not known to the simulator.")
+        spec = PIPETTES[name]
+        self.context = context
+        self.name = name
+        self.mount = mount
+        self.tip_racks = list(tip_racks or [])
+        self.starting_tip = None
+        self.min_volume = spec["min_volume"]
+        self.max_volume = spec["max_volume"]
+        self.flow_rate = FlowRates(spec["aspirate"], spec["dispense"])
+        self.current_volume = 0
+        self.tip = None
+        self.location = None
+        self._used_tips = set()
+
+    @property
+    def has_tip(self):
+        return self.tip is not None
+
+    def _resolve(self, location, bottom=True):
+        if location is None:
+            if self.location is None:
+                raise RuntimeError(f"The {self.mount} pipette has no location to work at.")
+            return self.location
+        if isinstance(location, Well):
+            if bottom:
+                return location.bottom(WELL_BOTTOM_CLEARANCE)
+            return location.top()
+        return location
+
+    def _record(self, command, text, location=None, volume=None):
+        entry = {"command": command, "mount": self.mount}
+        if volume is not None:
+            entry["volume"] = float(volume)
+        if location is not None:
+            well = location.labware
+            entry["slot"] = well.parent.slot
+            entry["well"] = well.well_name
+            entry["point"] = tuple(location.point)
+            self.location = location
+        self.context.record(entry, text)
+
+    def _capacity(self):
+        return min(self.max_volume, self.tip.max_volume)
+
+    def pick_up_tip(self, location=None):
+        if self.has_tip:
+            raise RuntimeError(f"The {self.mount} pipette already has a tip.")
+        if location is None:
+            tips = [tip for tip_rack in self.tip_racks for tip in tip_rack.wells()]
+            if self.starting_tip is not None:
+                tips = tips[tips.index(self.starting_tip):]
+            tips = [tip for tip in tips if id(tip) not in self._used_tips]
+            if not tips:
+                raise RuntimeError(f"The {self.mount} pipette has run out of tips.")
+            location = tips[0]
+        self._used_tips.add(id(location))
+        self.tip = location
+        self._record("pick_up_tip", f"Picking up tip from {location}", location.top())
+        return self
+
+    def drop_tip(self, location=None):
+        if not self.has_tip:
+            raise RuntimeError(f"The {self.mount} pipette has no tip to drop.")
+        location = self.context.fixed_trash["A1"] if location is None else location
+        self.tip = None
+        self.current_volume = 0
+        self._record("drop_tip", f"Dropping tip into {location}", self._resolve(location, False))
+        return self
+
+    def _draw(self, command, volume, location, rate=1.0):
+        if not self.has_tip:
+            raise RuntimeError(f"The {self.mount} pipette cannot aspirate without a tip.")
+        volume = self._capacity() - self.current_volume if volume is None else volume
+        if self.current_volume + volume > self._capacity() + 1e-9:
+            raise RuntimeError(
+                f"Cannot aspirate {volume} uL into the {self.mount} pipette holding "
+                f"{self.current_volume} uL of {self._capacity()} uL."
+            )
+        self.current_volume += volume
+        speed = self.flow_rate.aspirate * rate
+        self._record(
+            command,
+            f"Aspirating {float(volume)} uL from {location} at {speed} uL/sec",
+            location,
+            volume,
+        )
+        return self
+
+    def aspirate(self, volume=None, location=None, rate=1.0):
+        return self._draw("aspirate", volume, self._resolve(location), rate)
+
+    def dispense(self, volume=None, location=None, rate=1.0):
+        location = self._resolve(location)
+        volume = self.current_volume if volume is None else volume
+        if volume > self.current_volume + 1e-9:
+            raise RuntimeError(
+                f"Cannot dispense {volume} uL from the {self.mount} pipette holding "
+                f"{self.current_volume} uL."
+            )
+        self.current_volume -= volume
+        speed = self.flow_rate.dispense * rate
+        self._record(
+            "dispense",
+            f"Dispensing {float(volume)} uL into {location} at {speed} uL/sec",
+            location,
+            volume,
+        )
+        return self
+
+    def air_gap(self, volume=None, height=None):
+        if self.location is None:
+            raise RuntimeError(f"The {self.mount} pipette has no well to draw an air gap above.")
+        location = self.location.labware.top(5 if height is None else height)
+        return self._draw("air_gap", volume, location)
+
+    def blow_out(self, location=None):
+        location = self._resolve(location, False)
+        self.current_volume = 0
+        self._record("blow_out", f"Blowing out at {location}", location)
+        return self
+
+    def move_to(self, location):
+        self._record("move_to", f"Moving to {location}", location)
+        return self
+
+
+class RecordingContext:
+    """
+    Stand-in for `protocol_api.ProtocolContext` that records each step.
+
+    Attributes
+    ----------
+    command_log : list of dict
+        Structured record of each step, in order.
+    loaded_labware : dict
+        Labware loaded, keyed by deck slot.
+    loaded_instruments : dict
+        Pipettes loaded, keyed by mount.
+    delayed : float
+        Total time spent in delays. (in s)
+    """
+
+    def __init__(self, tip_racks=1):
+        """
+        Initialise the context.
+
+        Parameters
+        ----------
+        tip_racks : int
+            Number of racks each loaded tip rack stands for, for plans that
+            need more tips than the deck holds.
+
+        Returns
+        -------
+        None
+        """
+        self.tip_racks = tip_racks
+        self.command_log = []
+        self._commands = []
+        self.loaded_labware = {}
+        self.loaded_instruments = {}
+        self.delayed = 0.0
+        self.max_speeds = {}
+        self.fixed_trash = Labware("opentrons_1_trash_1100ml_fixed", TRASH_SLOT)
+
+    def record(self, entry, text):
+        self.command_log.append(entry)
+        self._commands.append(text)
+
+    def load_labware(self, load_name, location, label=None):
+        slot = int(location)
+        if slot in self.loaded_labware:
+            raise RuntimeError(f"Slot {slot} already holds {self.loaded_labware[slot]}.")
+        racks = self.tip_racks if "tiprack" in load_name else 1
+        labware = Labware(load_name, slot, racks)
+        self.loaded_labware[slot] = labware
+        return labware
+
+    def load_instrument(self, instrument_name, mount, tip_racks=None):
+        if mount in self.loaded_instruments:
+            raise RuntimeError(f"The {mount} mount already holds a pipette.")
+        pipette = Pipette(self, instrument_name, mount, tip_racks)
+        self.loaded_instruments[mount] = pipette
+        return pipette
+
+    def delay(self, seconds=0, minutes=0, msg=None):
+        seconds = minutes * 60 + seconds
+        self.delayed += seconds
+        self.record(
+            {"command": "delay", "seconds": float(seconds)},
+            f"Delaying for {int(seconds // 60)} minutes and {float(seconds % 60)} seconds",
+        )
+
+    def pause(self, msg=None):
+        self.record({"command": "pause", "message": msg}, f"Pausing robot operation: {msg}")
+
+    def comment(self, msg):
+        self.record({"command": "comment", "message": msg}, msg)
+
+    def is_simulating(self):
+        return True
+
+    def commands(self):
+        return list(self._commands)
+
+
+def _opentrons_shim():
+    """
+    Modules standing in for the parts of `opentrons` the scripts import.
+    """
+    protocol_api = types.ModuleType("opentrons.protocol_api")
+    protocol_api.ProtocolContext = RecordingContext
+    opentrons_types = types.ModuleType("opentrons.types")
+    opentrons_types.Point = Point
+    opentrons = types.ModuleType("opentrons")
+    opentrons.protocol_api = protocol_api
+    opentrons.types = opentrons_types
+    return {
+        "opentrons": opentrons,
+        "opentrons.protocol_api": protocol_api,
+        "opentrons.types": opentrons_types,
+    }
+
+
+def load_protocol(path):
+    """
+    Imports a protocol script against the stand-in `opentrons` package.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path of the protocol script.
+
+    Returns
+    -------
+    module
+        The protocol script, ready for its `run()` to be called.
+
+    """
+    path = Path(path)
+    spec = importlib.util.spec_from_file_location(path.stem.replace("-", "_"), str(path))
+    module = importlib.util.module_from_spec(spec)
+    shim = _opentrons_shim()
+    saved = {name: sys.modules[name] for name in shim if name in sys.modules}
+    sys.modules.update(shim)
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        for name in shim:
+            sys.modules.pop(name, None)
+        sys.modules.update(saved)
+    return module
+
+
+def simulate_protocol(path, context=None, **run_options):
+    """
+    Runs a protocol script against a recording protocol context.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path of the protocol script.
+    context : RecordingContext, optional
+        Context to run against, a new one by default.
+    **run_options
+        Overrides of the script's `run_options`.
+
+    Returns
+    -------
+    RecordingContext
+        The context the protocol ran against, holding the command stream.
+        What the script prints is kept in its `output`.
+
+    """
+    module = load_protocol(path)
+    module.run_options.update(run_options)
+    return _run(module, context)
+
+
+def _run(module, context=None):
+    """
+    Runs a loaded protocol script, keeping what it prints.
+    """
+    if context is None:
+        context = RecordingContext()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        module.run(context)
+    context.output = output.getvalue()
+    return context
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        start = time.perf_counter()
+        context = simulate_protocol(path)
+        elapsed = time.perf_counter() - start
+        print(f"{path} ({elapsed * 1000:.0f} ms)")
+        counts = Counter(entry["command"] for entry in context.command_log)
+        for command, count in sorted(counts.items()):
+            print(f"    {command:<12}{count:6d}")